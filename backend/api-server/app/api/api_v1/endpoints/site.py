@@ -19,6 +19,7 @@ from app.schemas.site import SiteInfo, SiteInfoWithSniffer, RssiMonitorConfigSit
 from app.core.core_config import settings
 from app.api.api_v1.endpoints.utils.exceptions import ArtichokeException
 from app.api.api_v1.endpoints.utils.token_verification import login_token_verification
+from app.api.api_v1.endpoints.utils.site_config import bump_site_config_version
 from app.api.api_v1.endpoints.utils.api_requests import get_frp_status
 from logging import config as logger_config
 from logging import getLogger
@@ -123,6 +124,7 @@ async def add_new_site(
 ) -> None:
     """Insert new site info to database."""
     crud_site.insert_new_site_info(db, new_site_info)
+    bump_site_config_version()
     return "Add New site_info Success."
 
 
@@ -167,6 +169,7 @@ async def update_one_site_info(
     """To update specified one site's information."""
     try:
         crud_site.update_site_info(db, site_id, new_site_info)
+        bump_site_config_version()
         return "Update site_info Success."
     except ArtichokeException as e:
         return HTTPException(status_code=400, detail=e.msg)
@@ -187,6 +190,7 @@ async def close_site(
     """To delete specified one site."""
     try:
         crud_site.delete_site_info(db, site_id)
+        bump_site_config_version()
         return "Delete site_info Success."
     except ArtichokeException as e:
         return HTTPException(status_code=400, detail=e.msg)
@@ -231,6 +235,7 @@ async def set_rssi_monitor_site(
 ) -> str:
     try:
         crud_site.insert_new_rssi_site(db, new_rssi_site)
+        bump_site_config_version()
         return "Insert rssi site info success."
     except ArtichokeException as e:
         return HTTPException(status_code=400, detail=e.msg)
@@ -256,4 +261,7 @@ async def create_upload_file(
         crud_site.update_site_office_hour(db, file.filename)
     except ArtichokeException as e:
         return HTTPException(status_code=400, detail=e.msg)
+    finally:
+        # The rows before a CSV error are committed already.
+        bump_site_config_version()
     return "Update office hour by csv success."
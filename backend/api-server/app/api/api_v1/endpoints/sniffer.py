@@ -25,6 +25,7 @@ from logging import getLogger
 from sqlalchemy.orm import Session
 from app.api.api_v1.endpoints.utils.exceptions import ArtichokeException
 from app.api.api_v1.endpoints.utils.token_verification import login_token_verification
+from app.api.api_v1.endpoints.utils.site_config import bump_site_config_version
 
 logger_config.dictConfig(settings.LOGGER_CONF)
 logger = getLogger(__name__)
@@ -105,6 +106,7 @@ async def add_new_sniffer(
 ) -> str:
     """Insert new sniffer info, and create database rawdata tables."""
     crud_sniffer.insert_new_sniffer_info(db, new_sniffer_info)
+    bump_site_config_version()
     q = Queue(connection=Redis('redis', 6379), default_timeout=3600)
     q.enqueue(
         'utility.create_db_table.worker_create_db_table',
@@ -149,6 +151,7 @@ async def update_sniffer_info(
     """Insert new sniffer info."""
     try:
         crud_sniffer.update_sniffer_info(db, sniffer_info)
+        bump_site_config_version()
         return "Update sniffer success."
     except ArtichokeException as e:
         return HTTPException(status_code=400, detail=e.msg)
@@ -169,6 +172,7 @@ async def delete_unused_sniffer(
     """Delete unused sniffer info."""
     try:
         crud_sniffer.delete_sniffer_by_sniffer_id(db, sniffer_id)
+        bump_site_config_version()
         return "Delete sniffer success."
     except ArtichokeException as e:
         return HTTPException(status_code=400, detail=e.msg)
@@ -191,6 +195,7 @@ async def sniffer_change_site(
     """Change sniffer to another site."""
     try:
         crud_sniffer.change_sniffer_for_site(db, sniffer_id, old_site_id, new_site_id)
+        bump_site_config_version()
         return "Change sniffer site success."
     except ArtichokeException as e:
         return HTTPException(status_code=400, detail=e.msg)
@@ -212,6 +217,7 @@ async def change_sniffer_isactive_status(
     """Change sniffer is active status."""
     try:
         crud_sniffer.change_is_active_status(db, sniffer_id, is_active)
+        bump_site_config_version()
         return f"Change sniffer: {sniffer_id} is_active status to {is_active} success."
     except ArtichokeException as e:
         return HTTPException(status_code=400, detail=e.msg)
@@ -237,6 +243,7 @@ async def set_rssi_monitor_sniffer(
 ) -> str:
     try:
         crud_sniffer.insert_new_rssi_sniffer_info(db, new_rssi_sniffer)
+        bump_site_config_version()
         return "Insert new rssi sniffer info success."
     except ArtichokeException as e:
         return HTTPException(status_code=400, detail=e.msg)
@@ -11,6 +11,7 @@ History:
 2021/10/07 Add Token Verification for Each Endpoint by Patrick
 """
 
+from datetime import datetime, timedelta
 from redis import Redis
 from rq import Queue
 from fastapi import APIRouter, HTTPException, Body, Depends
@@ -23,6 +24,7 @@ from app.schemas.utility import (
     AlertWeeklyInput,
     DbRoutineInput,
     DbRoutineInputOneSite,
+    DbRoutineRangeInput,
     DbBackupInput
 )
 from app.core.core_config import settings
@@ -218,6 +220,47 @@ async def re_calculate_db_routine_one_site(
     return db_routine_input
 
 
+@router.post(
+    "/db_routine_range",
+    dependencies=[Depends(login_token_verification)],
+    tags=["util"],
+    responses={400: {"description": "Bad Request"}},
+    summary='重新計算一段日期的人流數據',
+    description='輸入起訖日期 (含) 與 site_ids (可為 null, 表示所有門店)，日期格式為 YYYY-MM-DD，每 days_per_job 天交給 worker 一個工作，重送相同區間會從上次完成的日期繼續，已完成的日期不會重新計算'
+)
+async def re_calculate_db_routine_range(
+    db: Session = Depends(get_db_session),
+    db_routine_range_input: DbRoutineRangeInput = Body(
+        ...,
+        example={
+            "start_date": "2021-09-01",
+            "end_date": "2021-09-30",
+            "site_ids": ["1A01", "1A02"],
+            "days_per_job": 7
+        }
+    )
+):
+    try:
+        start_date = datetime.strptime(db_routine_range_input.start_date, '%Y-%m-%d').date()
+        end_date = datetime.strptime(db_routine_range_input.end_date, '%Y-%m-%d').date()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Dates must be YYYY-MM-DD.")
+    if end_date < start_date or db_routine_range_input.days_per_job < 1:
+        raise HTTPException(status_code=400, detail="end_date is before start_date or days_per_job < 1.")
+    q = Queue(connection=Redis('redis', 6379), default_timeout=14400)
+    while start_date <= end_date:
+        job_end_date = min(start_date + timedelta(days=db_routine_range_input.days_per_job - 1), end_date)
+        q.enqueue(
+            'worker_tmp_alg.worker_run_db_routine_range',
+            str(start_date),
+            str(job_end_date),
+            db_routine_range_input.site_ids
+        )
+        start_date = job_end_date + timedelta(days=1)
+    logger.info(db_routine_range_input)
+    return db_routine_range_input
+
+
 @router.post(
     "/missing_alarm",
     dependencies=[Depends(login_token_verification)],
@@ -0,0 +1,17 @@
+"""Version stamp of the site / sniffer configuration cached by the worker."""
+
+from logging import getLogger
+from redis import Redis, RedisError
+
+logger = getLogger(__name__)
+
+# Read by the worker's utility/site_config.py.
+VERSION_KEY = 'artichoke:site_config:version'
+
+
+def bump_site_config_version() -> None:
+    """Invalidate the worker's cached site_info / sniffer_info, after they are written."""
+    try:
+        Redis('redis', 6379, socket_timeout=1, socket_connect_timeout=1).incr(VERSION_KEY)
+    except RedisError as e:
+        logger.warning(f"Cannot bump the site config version: {e}")
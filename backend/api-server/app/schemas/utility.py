@@ -105,6 +105,30 @@ class DbRoutineInputOneSite(DbRoutineInput):
     )
 
 
+class DbRoutineRangeInput(BaseModel):
+
+    start_date: str = Field(
+        ...,
+        title="first date for the request calculating customer count",
+        example="2021-09-01"
+    )
+    end_date: str = Field(
+        ...,
+        title="last date for the request calculating customer count, included",
+        example="2021-09-30"
+    )
+    site_ids: Union[List[str], None] = Field(
+        None,
+        title="target site_ids, may be None for all sites",
+        example=["1A01", "1A02"]
+    )
+    days_per_job: int = Field(
+        7,
+        title="dates of each worker job",
+        example=7
+    )
+
+
 class DbBackupInput(BaseModel):
 
     year: int = Field(
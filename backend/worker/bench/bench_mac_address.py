@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python3
+"""
+sa as 12-character strings versus 48-bit integers (utility/mac_address.py).
+
+Times the operations of worker_tmp_alg on a store-day of rows: the (sa, rt)
+sort, first-seen dedup, per-sa counts and OUI prefix grouping, and reports
+the memory of the sa column in each form. The day is synthesized, or read
+from a sniffer table:
+    python bench/bench_mac_address.py --rows 1500000
+    python bench/bench_mac_address.py --db_url postgresql://... --sniffer aabbccddee01 --date 2021-08-05
+"""
+
+import os
+import sys
+import time
+import random
+from datetime import datetime, timedelta
+
+import click
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utility import mac_address  # noqa: E402
+
+
+def synthesize(rows, devices, seed=0):
+    """(rt microseconds, sa) of a store-day: mostly random MACs, some returning devices. """
+    rng = random.Random(seed)
+    day = int(datetime(2021, 8, 5, 10).timestamp() * 1000000)
+    known = ['%012x' % (rng.randrange(1 << 48) & ~mac_address.LOCALLY_ADMINISTERED) for _ in range(devices)]
+    rt, sa = [], []
+    for _ in range(rows):
+        rt.append(day + rng.randrange(12 * 3600 * 1000000))
+        sa.append(rng.choice(known) if rng.random() < 0.4 else '%012x' % (rng.randrange(1 << 48) | mac_address.LOCALLY_ADMINISTERED))
+    return np.array(rt, dtype=np.int64), sa
+
+
+def read_day(db_url, sniffer, day):
+    from sqlalchemy import create_engine
+    engine = create_engine(db_url)
+    start = datetime.strptime(day, '%Y-%m-%d')
+    rows = engine.execute(f"""SELECT (extract(epoch FROM rt) * 1000000)::bigint AS rt, sa FROM rawdata_{sniffer}
+                              WHERE rt BETWEEN '{start}' AND '{start + timedelta(days=1)}' AND {mac_address.sql_is_mac('sa')}""").fetchall()
+    return np.array([r[0] for r in rows], dtype=np.int64), [r[1] for r in rows]
+
+
+def measure(name, function, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print('{:<34} {:>10.1f} ms'.format(name, best * 1000))
+    return result
+
+
+def str_ops(rt, sa):
+    df = pd.DataFrame({'rt': rt, 'sa': sa})
+    df = measure('str: sort by (sa, rt)', lambda: df.sort_values(['sa', 'rt'], kind='mergesort'))
+    measure('str: first seen per sa', lambda: df.drop_duplicates('sa'))
+    measure('str: rows per sa', lambda: df['sa'].map(df['sa'].value_counts()))
+    measure('str: OUI prefix groups', lambda: df['rt'].groupby(df['sa'].str[:6]).shift(-4))
+    measure('str: randomized bit', lambda: df['sa'].str[1].isin(list('2367abef')))
+
+
+def int_ops(rt, sa):
+    order = measure('int: sort by (sa, rt)', lambda: np.lexsort((rt, sa)))
+    rt, sa = rt[order], sa[order]
+    measure('int: first seen per sa', lambda: np.unique(sa, return_index=True)[1])
+    measure('int: rows per sa', lambda: np.unique(sa, return_counts=True)[1])
+
+    def prefix_groups():
+        prefix = mac_address.oui(sa)
+        return (prefix[4:] == prefix[:-4]) & (rt[4:] - rt[:-4] <= 20*60*1000000)
+    measure('int: OUI prefix groups', prefix_groups)
+    measure('int: randomized bit', lambda: mac_address.is_randomized(sa))
+
+
+@click.command()
+@click.option('--rows', default=1500000, help='Rows of the synthesized store-day.')
+@click.option('--devices', default=20000, help='Returning devices of the synthesized store-day.')
+@click.option('--db_url', default=None, help='Read the day from this database instead.')
+@click.option('--sniffer', default=None, help='Sniffer table rawdata_{sniffer} of --db_url.')
+@click.option('--date', 'day', default=None, help='Day of --db_url, e.g. 2021-08-05.')
+def run(rows, devices, db_url, sniffer, day):
+    rt, sa = read_day(db_url, sniffer, day) if db_url else synthesize(rows, devices)
+    print('{:,} rows, {:,} distinct sa'.format(len(sa), len(set(sa))))
+
+    # A fetched row holds its own str object, plus a pointer in the list or object column.
+    str_bytes = sum(sys.getsizeof(s) for s in sa) + 8 * len(sa)
+    ints = measure('str -> int (to_ints)', lambda: mac_address.to_ints(sa))
+    print('{:<34} {:>10.1f} MB'.format('sa as str objects', str_bytes / 1e6))
+    print('{:<34} {:>10.1f} MB'.format('sa as int64 array', ints.nbytes / 1e6))
+
+    str_ops(rt, sa)
+    int_ops(rt, ints)
+
+
+if __name__ == '__main__':
+    run()
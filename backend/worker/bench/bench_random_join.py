@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python3
+"""
+Multi-sniffer random counts: the SQL FULL JOIN against random_join_hour_counts.
+
+Runs both on a site-day of rawdata and reports their time and whether the
+per-hour counts agree. With more than two sniffers the SQL joins them one
+after the other on coalesce() of the earlier sniffers' sa and rt:
+    python bench/bench_random_join.py --db_url postgresql://... --sniffers aabbccddee01,aabbccddee02 --date 2021-08-05
+"""
+
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+import click
+from sqlalchemy import create_engine
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from worker_tmp_alg import SiteWithSnifferInfo, db_session, random_join_hour_counts  # noqa: E402
+
+
+def sql_hour_counts(conn, sub_sqls):
+    rt, sa = 's0.rt', 's0.sa'
+    joins = []
+    for i, sub_sql in enumerate(sub_sqls[1:], 1):
+        joins.append(f"""FULL JOIN ({sub_sql}) s{i}
+            ON s{i}.sa = {sa} AND {rt} - s{i}.rt BETWEEN interval '-00:01' AND interval '00:01'""")
+        rt, sa = f'coalesce({rt}, s{i}.rt)', f'coalesce({sa}, s{i}.sa)'
+    joins = '\n'.join(joins)
+    res = conn.execute(f"""SET session time zone 'Asia/Taipei';
+        SELECT date_part('hour', {rt})::int, count(1)
+        FROM ({sub_sqls[0]}) s0
+        {joins}
+        GROUP BY 1
+    """)
+    counts = [0] * 24
+    for hour, count in res.fetchall():
+        counts[hour] = count
+    return counts
+
+
+@click.command()
+@click.option('--db_url', required=True, help='Database of the rawdata_{sniffer} tables.')
+@click.option('--sniffers', required=True, help='Comma separated sniffers of the site.')
+@click.option('--rssi', default=-80, help='rssi threshold of every sniffer.')
+@click.option('--date', 'day', required=True, help='Day to count, e.g. 2021-08-05.')
+def run(db_url, sniffers, rssi, day):
+    sniffers = sniffers.split(',')
+    start = datetime.strptime(day, '%Y-%m-%d').date()
+    conn = next(db_session(create_engine(db_url)))
+    site_info = ('bench', None, None, None, None, 2, 1, 1, {}, sniffers, [rssi] * len(sniffers))
+    site = SiteWithSnifferInfo(site_info, start, start + timedelta(days=1), conn, sp_dt=True)
+
+    begin = time.perf_counter()
+    sql_counts = sql_hour_counts(conn, site._get_sub_sql_stmt_for_random_count())
+    sql_seconds = time.perf_counter() - begin
+
+    begin = time.perf_counter()
+    sniffer_rows = site._get_random_rows()
+    fetch_seconds = time.perf_counter() - begin
+    merge_counts = random_join_hour_counts(sniffer_rows)
+    merge_seconds = time.perf_counter() - begin
+
+    print('{:,} random rows of {} sniffers'.format(sum(len(r) for r in sniffer_rows), len(sniffers)))
+    print('SQL FULL JOIN   {:8.3f} s'.format(sql_seconds))
+    print('merge join      {:8.3f} s (fetch {:.3f} s)'.format(merge_seconds, fetch_seconds))
+    print('joined rows     {:,} / {:,}'.format(sum(sql_counts), sum(merge_counts)))
+    print('same per-hour counts:', sql_counts == merge_counts)
+    conn.close()
+
+
+if __name__ == '__main__':
+    run()
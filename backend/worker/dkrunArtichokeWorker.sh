@@ -14,4 +14,6 @@ docker run -d \
     -e db_url=${db_url} \
     -e TZ=Asia/Taipei \
     -v /Users/mac/testrite/artichoke_server/backend/worker/main.py:/worker/main.py \
+    -v artichoke_worker_incremental_state:/worker/incremental_state \
+    -v artichoke_worker_backfill_state:/worker/backfill_state \
     wifiprobe.edt.testritegroup.com:5000/artichoke_worker:${tag}
@@ -78,8 +78,12 @@ def setup_db_routine_cron_job():
     logger.info("Setting up db routine cron job")
     try:
         with CronTab(user="root") as cron:
-            job = cron.new(command="/usr/local/bin/python /worker/worker_tmp_alg.py")
+            job = cron.new(command="/usr/local/bin/python /worker/worker_tmp_alg.py --incremental")
             job.setall('5,15,25,35,45,55 10-21 * * *')
+            # The incremental runs skip rawdata stored late, e.g. forwarded after an outage,
+            # and keep the hours they closed. Recount yesterday in full once its rawdata is in.
+            nightly = cron.new(command="/usr/local/bin/python /worker/worker_tmp_alg.py --days_ago 1")
+            nightly.setall('30 2 * * *')
     except Exception as e:
         logger.error("Error setting up log cleaning cron job")
         logger.error(f"Exception details: {e}")
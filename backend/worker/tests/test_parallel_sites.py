@@ -0,0 +1,57 @@
+"""
+_compute_sites on a process pool and on threads.
+
+SiteWithSnifferInfo.compute is replaced by one that reports the process it ran in, which the
+forked pool processes inherit; the sites still get their connection from _site_engine.
+"""
+import os
+import sys
+from datetime import date, time, timedelta
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import worker_tmp_alg  # noqa: E402
+from worker_tmp_alg import SiteWithSnifferInfo  # noqa: E402
+
+DB_URL = 'sqlite://'
+DAY = date(2021, 8, 5)
+
+
+def site_info(site_id):
+    return (site_id, time(10), time(22), time(10), time(22), 2, 1, 1, None, ['sniffer'], [-90])
+
+
+def compute(self):
+    if self._site_id == 'broken':
+        raise RuntimeError('no rawdata')
+    # The connection comes from this process's own engine.
+    assert self._conn.bind is worker_tmp_alg._site_engine(DB_URL)
+    return [(self._site_id, os.getpid())]
+
+
+@pytest.fixture
+def args(monkeypatch):
+    monkeypatch.setattr(SiteWithSnifferInfo, 'compute', compute)
+    return [(DB_URL, site_info(site_id), DAY, DAY + timedelta(days=1), True, None, 0)
+            for site_id in ['A', 'B', 'C', 'D', 'broken']]
+
+
+@pytest.mark.parametrize('executor', ['process', 'thread'])
+def test_compute_sites(args, executor):
+    results = {a[1][0]: output for a, output in worker_tmp_alg._compute_sites(args, 2, executor)}
+    assert sorted(results) == ['A', 'B', 'C', 'D', 'broken']
+    assert results.pop('broken') is None
+    assert all(output[0][0] == site_id for site_id, output in results.items())
+    pids = {output[0][1] for output in results.values()}
+    if executor == 'process':
+        assert os.getpid() not in pids
+    else:
+        assert pids == {os.getpid()}
+
+
+def test_compute_sites_serial(args):
+    results = list(worker_tmp_alg._compute_sites(args, 1, 'process'))
+    assert [a[1][0] for a, _ in results] == ['A', 'B', 'C', 'D', 'broken']
+    assert [output for _, output in results][:4] == [[(site_id, os.getpid())] for site_id in 'ABCD']
@@ -0,0 +1,116 @@
+"""
+SiteWithSnifferInfo._exclude_samsung_random_rawdata against the row-by-row loop it replaced.
+
+The loop is kept below as the reference. Rows whose sa is not 12 hex digits are
+dropped when the rawdata is loaded, so the reference runs on the rows the loader
+keeps and the dropped rows must not come back in the result.
+"""
+import os
+import random
+import sys
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import worker_tmp_alg  # noqa: E402
+from utility import mac_address  # noqa: E402
+from worker_tmp_alg import RawdataColumns, SiteWithSnifferInfo  # noqa: E402
+
+OUI_LIST = SiteWithSnifferInfo.OUI_LIST
+DAY = datetime(2021, 8, 5, 10, tzinfo=timezone.utc)
+NON_HEX_SAS = ['', 'unknown', '00:11:22:33:44:55', 'zz0011223344', 'a4b1c2d3e4', 'a4b1c2d3e4f5a', 'a4b1c2d3e4fg']
+
+
+def legacy_exclude_samsung_random_rawdata(all_rawdata_sniffers, sniffer_count):
+    all_rawdatas = list()
+    for rd in all_rawdata_sniffers:
+        all_rawdatas.extend(rd)
+    all_rawdatas = sorted(all_rawdatas, key=lambda s: (s[1], s[0])) # s[1]: sa, s[0]: rt
+    excluded_random_rawdatas = all_rawdatas[:]
+    excluded_random_rawdatas = [rw for rw in excluded_random_rawdatas if rw[2] in OUI_LIST and rw[3] == 0]
+    mac_addr_prefix = set(map(lambda x:x[1][:6], excluded_random_rawdatas))
+    group_by_sa = [[y for y in excluded_random_rawdatas if y[1][:6] == x] for x in mac_addr_prefix]
+    final_excluded_sa = list()
+    for value, sa in zip(mac_addr_prefix, group_by_sa):
+        mac_addr_list = [s[1] for s in sa]
+        excluded_sa = [
+            mac_addr for mac_addr in mac_addr_list
+            if mac_addr_list.count(mac_addr) > sniffer_count
+        ]
+        candidate_exclude_sas = [s for s in mac_addr_list if s not in excluded_sa]
+        sa = [s for s in sa if s[1] in candidate_exclude_sas]
+        for idx, s in enumerate(sa):
+            try:
+                if sa[idx+4][0] - s[0] <= timedelta(minutes=20):
+                    final_excluded_sa.extend(candidate_exclude_sas)
+                    break
+            except IndexError:
+                break
+    return [rw for rw in all_rawdatas if rw[1] not in final_excluded_sa]
+
+
+def generate_sniffers(rng, sniffer_count):
+    """Rows (rt, sa, cname, pkt_type) of each sniffer, dense enough to hit the 20 minute window. """
+    prefixes = ['%06x' % rng.getrandbits(24) for _ in range(rng.randint(1, 6))] + ['a4b1c2']
+    sas = [p + '%06x' % rng.getrandbits(24) for p in prefixes for _ in range(rng.randint(1, 5))]
+    sniffers = []
+    for _ in range(sniffer_count):
+        rows = []
+        for _ in range(rng.randint(0, 60)):
+            sa = rng.choice(NON_HEX_SAS) if rng.random() < 0.1 else rng.choice(sas)
+            # Whole minutes, so rows exactly 20 minutes apart occur.
+            rt = DAY + timedelta(minutes=rng.randint(0, 90), microseconds=rng.choice([0, 0, 1]))
+            cname = rng.choice(OUI_LIST[:3] + ['Apple', 'Google_Random', None])
+            rows.append((rt, sa, cname, rng.choice([0, 0, 0, 4, None])))
+        sniffers.append(rows)
+    return sniffers
+
+
+def load(monkeypatch, rows) -> RawdataColumns:
+    """RawdataColumns.fetch of the rows, as the server-side cursor returns them. """
+    def stream_rows(session, sql):
+        yield [(int((rt - datetime(1970, 1, 1, tzinfo=timezone.utc)) / timedelta(microseconds=1)), sa, cname,
+                -1 if pkt_type is None else pkt_type) for rt, sa, cname, pkt_type in rows]
+    monkeypatch.setattr(worker_tmp_alg, 'stream_rows', stream_rows)
+    return RawdataColumns.fetch(None, '')
+
+
+def as_keys(rows):
+    epoch = datetime(1970, 1, 1, tzinfo=timezone.utc)
+    return sorted((int((rt - epoch) / timedelta(microseconds=1)), sa) for rt, sa, _, _ in rows)
+
+
+@pytest.mark.parametrize('seed', range(200))
+def test_matches_legacy_loop(monkeypatch, seed):
+    rng = random.Random(seed)
+    sniffer_count = rng.randint(1, 3)
+    sniffers = generate_sniffers(rng, sniffer_count)
+    site_info = ('site', None, None, None, None, 2, 1, 1, None, [f'sniffer{i}' for i in range(sniffer_count)],
+                 [-90] * sniffer_count)
+    site = SiteWithSnifferInfo(site_info, DAY.date(), DAY.date(), None)
+
+    rawdata = load(monkeypatch, [rw for rd in sniffers for rw in rd])
+    kept = site._exclude_samsung_random_rawdata(rawdata)
+    result = sorted(zip(rawdata.rt[kept].tolist(), mac_address.to_strs(rawdata.sa[kept]).tolist()))
+
+    valid = [[rw for rw in rd if rw[1] not in NON_HEX_SAS] for rd in sniffers]
+    expected = as_keys(legacy_exclude_samsung_random_rawdata(valid, sniffer_count))
+    assert result == expected
+    assert not set(NON_HEX_SAS) & {sa for _, sa in result}
+
+
+def test_excludes_a_burst_of_random_sa():
+    # Five rows of one prefix inside 20 minutes, each sa seen once by the only sniffer.
+    rows = [(DAY + timedelta(minutes=5 * i), f'a4b1c2d3e4f{i}', 'SamsungE', 0) for i in range(5)]
+    rows.append((DAY, '001122334455', 'SamsungE', 0))
+    rows.append((DAY, 'a4b1c2xxxxxx', 'SamsungE', 0))
+    assert legacy_exclude_samsung_random_rawdata([rows[:5] + rows[5:6]], 1) == [rows[5]]
+
+    site = SiteWithSnifferInfo(('site', None, None, None, None, 2, 1, 1, None, ['sniffer'], [-90]),
+                               DAY.date(), DAY.date(), None)
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        rawdata = load(monkeypatch, rows)
+    kept = site._exclude_samsung_random_rawdata(rawdata)
+    assert mac_address.to_strs(rawdata.sa[kept]).tolist() == ['001122334455']
@@ -12,6 +12,7 @@ from configparser import ConfigParser
 from argparse import ArgumentParser
 from urllib.parse import urlparse
 from utility.get_db_session import db_session
+from utility import site_config
 
 import asyncssh
 import pytz
@@ -284,7 +285,8 @@ class MonitorTask:
 
         # 將 site_id 一些後綴字樣全剔除 (如: 1A06-TEST, 1A09-UPS, ...)
         sql = f"""SET SESSION TIME ZONE 'Asia/Taipei';
-        SELECT site_id, sname, sniffer, union_sniffer, is_released, machine_area, machine_location, sniffer_no, tel
+        SELECT site_id, sname, sniffer, union_sniffer, is_released, machine_area, machine_location, sniffer_no, tel,
+        {col_open_hour} + INTERVAL '{open_hour_buffer}' AS open_from, {col_closed_hour}
         FROM (
             SELECT si_i.site_id AS site_id, si_i.sname AS sname, si_i.{col_open_hour}, si_i.{col_closed_hour},
             si_i.is_released AS is_released, si_i.tel AS tel,
@@ -305,7 +307,9 @@ class MonitorTask:
         ) as t
         """
 
-        sql += f""" WHERE CURRENT_TIME BETWEEN {col_open_hour} + INTERVAL '{open_hour_buffer}' AND {col_closed_hour}"""
+        # The opening hours are filtered below, so the query is the same all day and can be cached.
+        # The buffer stays in SQL, which reads every interval spelling, e.g. '20 mins'.
+        sql += """ WHERE true"""
         if site_type:
             sql += """ AND channel~'{}' """.format(site_type)
         if site_id:
@@ -314,7 +318,20 @@ class MonitorTask:
             sql += """ AND site_id NOT IN ({}) """.format(
                 ','.join([f"'{site_id}'" for site_id in ignore_site_list]))
 
-        data = pd.read_sql(sql=sql, con=self._slave_db_url)
+        data = site_config.read_sql(sql, self._slave_db_url)
+        # CURRENT_TIME BETWEEN open_from AND {col_closed_hour}
+        tz_tw = pytz.timezone('Asia/Taipei')
+        now = datetime.now(tz_tw)
+
+        def today_at(t):
+            dt = datetime.combine(now.date(), t)
+            return dt if dt.tzinfo else tz_tw.localize(dt)
+
+        # A NULL opening hour never matched the BETWEEN of the query.
+        data = data.dropna(subset=['open_from', col_closed_hour])
+        is_open = np.array([today_at(o) <= now <= today_at(c)
+                            for o, c in zip(data['open_from'], data[col_closed_hour])], dtype=bool)
+        data = data.loc[is_open].drop(columns=['open_from', col_closed_hour]).reset_index(drop=True)
         data.rename(columns={
             'machine_area': '安裝區域',
             'machine_location': '安裝方式',
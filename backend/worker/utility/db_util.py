@@ -15,6 +15,8 @@ import math
 
 import click
 
+from utility import site_config
+
 logger = logging.getLogger(__name__)
 
 def read_active_site_info(db_url, store_type=None, site_id=None):
@@ -26,7 +28,7 @@ def read_active_site_info(db_url, store_type=None, site_id=None):
         sql += """and channel='{}' """.format(store_type)
     if site_id:
         sql += """and site_id='{}' """.format(site_id)
-    data = pd.read_sql(sql=sql, con=db_url).set_index('site_id')
+    data = site_config.read_sql(sql, db_url).set_index('site_id')
     return data
 
 def create_newyear_rawdata_table(db_url, year, **kwargs):
@@ -0,0 +1,66 @@
+"""
+MAC addresses as 48-bit integers.
+
+rawdata stores sa / da as 12 lowercase hex digits. As an int64 a MAC sorts
+the same way, its OUI prefix (the first 6 hex digits) is a shift and the
+locally administered bit, set by randomized MACs, is a mask. The array
+functions take and return NumPy arrays.
+"""
+import numpy as np
+
+OUI_SHIFT = 24
+# The 0x02 bit of the first octet.
+LOCALLY_ADMINISTERED = 1 << 41
+
+
+def sql_is_mac(column: str = 'sa') -> str:
+    """SQL condition of the rows whose column is 12 hex digits. """
+    return f"{column} ~ '^[0-9a-f]{{12}}$'"
+
+
+def to_str(value: int) -> str:
+    return f'{value:012x}'
+
+
+def oui(value):
+    """The OUI prefix of an int or an int64 array. """
+    return value >> OUI_SHIFT
+
+
+def is_randomized(value):
+    """Whether the locally administered bit is set, for an int or an int64 array. """
+    return (value & LOCALLY_ADMINISTERED) != 0
+
+
+_HEX_VALUES = np.full(256, -1, dtype=np.int64)
+_HEX_VALUES[np.frombuffer(b'0123456789abcdef', dtype=np.uint8)] = np.arange(16)
+_HEX_VALUES[np.frombuffer(b'ABCDEF', dtype=np.uint8)] = np.arange(10, 16)
+_NIBBLE_WEIGHTS = 16 ** np.arange(11, -1, -1, dtype=np.int64)
+
+
+def to_ints(macs, strict: bool = True) -> np.ndarray:
+    """
+    int64 array of 12 hex digit MAC strings.
+
+    Anything else raises ValueError, or converts to -1 when not `strict`.
+    """
+    try:
+        # One spare byte, so longer strings are not cut to 12.
+        digits = np.array(macs, dtype='S13')
+    except UnicodeEncodeError:
+        digits = np.array([m.encode('ascii', 'replace') for m in macs], dtype='S13')
+    chars = digits.view(np.uint8).reshape(-1, 13)
+    nibbles = _HEX_VALUES[chars[:, :12]]
+    # Shorter strings are padded with NUL, which is not a hex digit.
+    invalid = (nibbles < 0).any(axis=1) | (chars[:, 12] != 0)
+    values = nibbles @ _NIBBLE_WEIGHTS
+    if invalid.any():
+        if strict:
+            raise ValueError('MAC addresses must be 12 hex digits.')
+        values[invalid] = -1
+    return values
+
+
+def to_strs(values: np.ndarray) -> np.ndarray:
+    """Array of 12 hex digit strings of an int64 array. """
+    return np.array([f'{v:012x}' for v in values.tolist()], dtype='U12')
@@ -14,6 +14,8 @@ from email.header import Header
 from configparser import ConfigParser
 from typing import Union
 
+from utility import site_config
+
 logger = logging.getLogger(__name__)
 tz_tw = pytz.timezone('Asia/Taipei')
 
@@ -244,7 +246,7 @@ class MissingRecordDetection:
         sql += f""" WHERE si_i.site_id not in ({", ".join([f"'{ignore_site}'" for ignore_site in self._ignore_detect_list])}) """
         if self._site_id:
             sql += f""" AND si_i.site_id='{self._site_id}' """
-        data = pd.read_sql(sql=sql, con=self._db_url).set_index('site_id')
+        data = site_config.read_sql(sql, self._db_url).set_index('site_id')
         return data
 
     def _send_edt_alert_mail(self, title, content) -> None:
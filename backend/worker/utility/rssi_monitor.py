@@ -7,11 +7,12 @@ from email.header import Header
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from configparser import ConfigParser
-from sqlalchemy import create_engine
 
 import pandas as pd
 import pytz
 
+from utility import site_config
+
 LOG_FORMAT = '%(asctime)-15s %(levelname)s %(processName)s-%(threadName)s,%(module)s,%(funcName)s,ln %(lineno)d: %(message)s'
 LOG_LEVEL = logging.INFO
 logger = logging.getLogger(__name__)
@@ -38,7 +39,6 @@ def to_recipients(config_path: str) -> [str, str, str]:
 
 
 def params(db_url: str):
-    engine = create_engine(db_url)
     sql_stmt = """
         SELECT site_id, sname, day_from, array_agg(rssi) AS rssi, android_rate, wifi_rate,
         array_agg(sniffer_id) AS sniffer_id, array_agg(rssi_group) AS rssi_group
@@ -50,8 +50,7 @@ def params(db_url: str):
 	        ) AS B ON A.site_id = B.site_id
         ) AS foo GROUP BY site_id, sname, android_rate, wifi_rate, day_from
     """
-    res = engine.execute(sql_stmt)
-    result = res.fetchall()
+    result = site_config.fetch_all(sql_stmt, db_url)
     return_rssis = list()
     for site in result:
         site_id, sname, day_from, rssi, android_rate, wifi_rate, sniffer_ids, rssi_groups = site
@@ -0,0 +1,72 @@
+"""
+Site and sniffer configuration cached in Redis.
+
+The worker jobs read site_info / sniffer_info with a few queries that only
+change when a site or sniffer is edited. A query's result is pickled into
+Redis under the configuration version, which the API bumps on every site or
+sniffer write, so a job only queries the database again after a change.
+Entries also expire after CACHE_TTL seconds, for edits made straight in the
+database. Without Redis the queries run on the database as before.
+"""
+import hashlib
+import logging
+import pickle
+from typing import List
+
+import pandas as pd
+from redis import Redis, RedisError
+from sqlalchemy import create_engine
+
+logger = logging.getLogger(__name__)
+
+REDIS_HOST = 'redis'
+REDIS_PORT = 6379
+# Also bumped by the API server, see app/api/api_v1/endpoints/utils/site_config.py.
+VERSION_KEY = 'artichoke:site_config:version'
+CACHE_TTL = 3600
+
+_redis = None
+
+
+def _client() -> Redis:
+    global _redis
+    if _redis is None:
+        _redis = Redis(REDIS_HOST, REDIS_PORT, socket_timeout=1, socket_connect_timeout=1)
+    return _redis
+
+
+def _cached(db_url: str, sql: str, query):
+    """query() of the sql, from Redis when the configuration did not change since it ran. """
+    try:
+        client = _client()
+        version = int(client.get(VERSION_KEY) or 0)
+        key = f'artichoke:site_config:{version}:{hashlib.sha1((db_url + sql).encode()).hexdigest()}'
+        data = client.get(key)
+        if data is not None:
+            return pickle.loads(data)
+    except RedisError as e:
+        logger.warning(f'Site config cache unavailable, reading the database: {e}')
+        return query()
+    result = query()
+    try:
+        client.set(key, pickle.dumps(result), ex=CACHE_TTL)
+    except RedisError as e:
+        logger.warning(f'Cannot cache the site config: {e}')
+    return result
+
+
+def read_sql(sql: str, db_url: str) -> pd.DataFrame:
+    """pd.read_sql of a site_info / sniffer_info query, cached. """
+    return _cached(db_url, sql, lambda: pd.read_sql(sql=sql, con=db_url))
+
+
+def fetch_all(sql: str, db_url: str) -> List[tuple]:
+    """Rows of a site_info / sniffer_info query as tuples, cached. """
+    def query():
+        engine = create_engine(db_url)
+        try:
+            return [tuple(row) for row in engine.execute(sql).fetchall()]
+        finally:
+            engine.dispose()
+    return _cached(db_url, sql, query)
+
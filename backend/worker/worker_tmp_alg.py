@@ -1,10 +1,21 @@
 import os
-from typing import Generator
+import io
+import csv
+import json
+import hashlib
+from typing import Generator, Iterable, List
 import time
+import click
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from sqlalchemy import create_engine
-from datetime import date, datetime, timedelta
+from datetime import date, datetime, timedelta, timezone
 from sqlalchemy.orm import sessionmaker, Session
+import numpy as np
+import pandas as pd
+import pytz
 import logging
+from utility import mac_address, site_config
 logger = logging.getLogger()
 
 
@@ -29,16 +40,131 @@ def db_session(engine) -> Generator[Session, None, None]:
         db.rollback()
 
 
+TIME_ZONE = 'Asia/Taipei'
+
+
+def _hours(rt: np.ndarray) -> np.ndarray:
+    """Hours in TIME_ZONE of epoch microseconds. """
+    return pd.to_datetime(rt, unit='us', utc=True).tz_convert(TIME_ZONE).hour.values
+
+
 class RawdataInfo:
-    def __init__(self, rt: datetime, sa: str):
-        self._rt = rt
-        self._sa = sa
+    """
+    rt (epoch microseconds) and sa (48-bit int) of rawdata rows, as two arrays.
+    """
+    __slots__ = ('rt', 'sa')
+
+    def __init__(self, rt: np.ndarray = None, sa: np.ndarray = None):
+        self.rt = rt if rt is not None else np.empty(0, dtype=np.int64)
+        self.sa = sa if sa is not None else np.empty(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.rt)
 
-    def get_rt(self):
-        return self._rt
+    def first_seen(self) -> 'RawdataInfo':
+        """The earliest row of every sa. """
+        order = np.lexsort((self.rt, self.sa))
+        first = order[np.unique(self.sa[order], return_index=True)[1]]
+        return RawdataInfo(self.rt[first], self.sa[first])
 
-    def get_sa(self):
-        return self._sa
+    def hour_counts(self) -> list:
+        """Rows per hour of the day. """
+        return np.bincount(_hours(self.rt), minlength=24)[:24].tolist()
+
+
+def stream_rows(session: Session, sql: str, chunk_size: int = 100000) -> Generator[list, None, None]:
+    """Chunks of the rows of `sql` from a server-side cursor, in the session time zone TIME_ZONE. """
+    conn = session.connection()
+    conn.execute(f"SET SESSION time zone '{TIME_ZONE}'")
+    # A named psycopg2 cursor in the session's transaction; plain tuples cost less than result rows.
+    cursor = conn.connection.cursor(name='rawdata_stream')
+    try:
+        cursor.execute(sql)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        cursor.close()
+
+
+def _full_join(rt: np.ndarray, sa: np.ndarray, rt2: np.ndarray, sa2: np.ndarray, window: int):
+    """
+    rt of the rows of `rt, sa FULL JOIN rt2, sa2 ON sa = sa2 AND rt - rt2 BETWEEN -window AND window`,
+    as coalesce(rt, rt2), with their sa.
+    """
+    if not len(rt) or not len(rt2):
+        return np.concatenate([rt, rt2]), np.concatenate([sa, sa2])
+    # One sorted key per row: the rank of its sa above the rt offset, so a window never leaves its sa.
+    t0 = min(rt.min(), rt2.min())
+    assert max(rt.max(), rt2.max()) - t0 + window < 1 << 40
+    _, rank = np.unique(np.concatenate([sa, sa2]), return_inverse=True)
+    key, key2 = (rank[:len(sa)] << 40) | (rt - t0), (rank[len(sa):] << 40) | (rt2 - t0)
+    sorted_key, sorted_key2 = np.sort(key), np.sort(key2)
+    matches = np.searchsorted(sorted_key2, key + window, 'right') - np.searchsorted(sorted_key2, key - window, 'left')
+    unmatched2 = np.searchsorted(sorted_key, key2 + window, 'right') == np.searchsorted(sorted_key, key2 - window, 'left')
+    repeat = np.maximum(matches, 1)
+    return np.concatenate([np.repeat(rt, repeat), rt2[unmatched2]]), np.concatenate([np.repeat(sa, repeat), sa2[unmatched2]])
+
+
+def random_join_hour_counts(sniffer_rows: List[RawdataInfo], window: int = 60*1000000, count_from: int = None) -> list:
+    """
+    Rows per hour of the FULL JOIN of the sniffers' random rows on equal sa and rt within `window`.
+
+    More sniffers join one after the other, each on the rt of the first sniffer in the joined row,
+    as `(a FULL JOIN b ON ...) FULL JOIN c ON c.sa = coalesce(a.sa, b.sa) AND ...` would. Rows before
+    `count_from` (epoch microseconds) are not counted.
+    """
+    rt, sa = sniffer_rows[0].rt, sniffer_rows[0].sa
+    for rows in sniffer_rows[1:]:
+        rt, sa = _full_join(rt, sa, rows.rt, rows.sa, window)
+    if count_from is not None:
+        rt = rt[rt >= count_from]
+    return RawdataInfo(rt).hour_counts()
+
+
+class RawdataColumns:
+    """
+    rt, sa, cname and pkt_type of the rawdata rows as arrays, sorted by sa and rt.
+
+    rt is in epoch microseconds, sa the 48-bit MAC as int64 and cname a category code into
+    `categories`; a NULL pkt_type is -1. Rows whose sa is not 12 hex digits are dropped.
+    """
+
+    SELECT_RT_SA = "(extract(epoch FROM rt) * 1000000)::bigint, sa"
+    SELECT = f"{SELECT_RT_SA}, cname, coalesce(pkt_type, -1)"
+
+    def __init__(self, rt: np.ndarray, sa: np.ndarray, cname: np.ndarray, pkt_type: np.ndarray, categories: list):
+        order = np.lexsort((rt, sa))
+        self.rt, self.sa, self.cname, self.pkt_type = rt[order], sa[order], cname[order], pkt_type[order]
+        self.categories = categories
+
+    def __len__(self):
+        return len(self.rt)
+
+    @classmethod
+    def fetch(cls, session: Session, sql: str) -> 'RawdataColumns':
+        """Stream the rows of `sql`, which selects SELECT, through a server-side cursor. """
+        codes = dict()
+        chunks = []
+        for rows in stream_rows(session, sql):
+            rt, sa, cname, pkt_type = zip(*rows)
+            chunk = (np.array(rt, dtype=np.int64), mac_address.to_ints(sa, strict=False),
+                     np.array([codes.setdefault(c, len(codes)) for c in cname], dtype=np.int16),
+                     np.array(pkt_type, dtype=np.int16))
+            valid = chunk[1] >= 0
+            chunks.append(tuple(c[valid] for c in chunk))
+        if not chunks:
+            empty = np.empty(0, dtype=np.int64)
+            return cls(empty, empty, empty.astype(np.int16), empty.astype(np.int16), [])
+        return cls(*(np.concatenate(c) for c in zip(*chunks)), list(codes))
+
+    def cname_in(self, names) -> np.ndarray:
+        return np.isin(self.cname, [code for code, c in enumerate(self.categories) if c in names])
+
+    def rows(self, mask: np.ndarray) -> RawdataInfo:
+        return RawdataInfo(self.rt[mask], self.sa[mask])
 
 
 class SiteWithSnifferInfo:
@@ -49,7 +175,7 @@ class SiteWithSnifferInfo:
     def __init__(self, site_info: tuple, start_date: date, end_date: date, conn, sp_dt=False):
         self._site_id, open_hour, closed_hour, open_hour_wend, closed_hour_wend, \
         self._alg_version, self._android_rate, self._wifi_rate, self._alg_params, self._sniffer_id, self._rssi = site_info
-        self._unique_cnames, self._random_cnames = list(), list()
+        self._unique_cnames, self._random_cnames = RawdataInfo(), RawdataInfo()
         self._unique_period_counts, self._random_period_counts = [0]*24, [0]*24
         self._conn = conn
         self._start_date = start_date
@@ -62,91 +188,73 @@ class SiteWithSnifferInfo:
             self._open_hour, self._closed_hour = open_hour_wend, closed_hour_wend
 
     def main_proc(self):
-        self._insert_rawdata_lists()
-        self._calculate_hour_counts()
+        self.compute()
         self._upsert_to_database()
 
-    def _get_result(self):
-        l = []
-        for s, rssi in zip(self._sniffer_id, self._rssi):
-            sql = f"""
-                SET SESSION time zone 'Asia/Taipei';
-                SELECT rt, sa, cname, pkt_type FROM rawdata_{s}
+    def compute(self) -> List[tuple]:
+        """Count the customers and return the customer_count rows. """
+        self._insert_rawdata_lists()
+        self._calculate_hour_counts()
+        return self._get_output_rows()
+
+    def _get_result(self, since=None, until=None) -> RawdataColumns:
+        """Rows of every sniffer in the day, or with since < rt <= until when until is given. """
+        rt_range = f"rt BETWEEN '{self._start_date}' AND '{self._end_date}'"
+        if until is not None:
+            rt_range = (f"rt > '{since}'" if since is not None else f"rt >= '{self._start_date}'") + f" AND rt <= '{until}'"
+        sql = " UNION ALL ".join(f"""
+                SELECT {RawdataColumns.SELECT} FROM rawdata_{s}
                 WHERE rssi >= {rssi}
-                AND rt BETWEEN '{self._start_date}' AND '{self._end_date}' ORDER BY rt
-            """
-            res = self._conn.execute(sql)
-            l.append(res.fetchall())
-        return l
+                AND {rt_range}
+            """ for s, rssi in zip(self._sniffer_id, self._rssi))
+        return RawdataColumns.fetch(self._conn, sql)
 
     def _insert_rawdata_lists(self):
-        all_rawdata_sniffers = self._get_result()
-        excluded_samsung_random_rawdata = self._exclude_samsung_random_rawdata(all_rawdata_sniffers)
-        for raw in excluded_samsung_random_rawdata:
-            rt, sa, cname, pkt_type = raw
-            if cname in self.OUI_LIST:
-                self._unique_cnames.append(RawdataInfo(rt, sa))
-            elif cname in ("Google_Random", None) and (pkt_type == 0) and len(self._sniffer_id) == 1:
-                if self._alg_version == 1:
-                    # Algorithm ver1 needn't deal with random cnames.
-                    continue
-                self._random_cnames.append(RawdataInfo(rt, sa))
-        if len(self._sniffer_id) > 1:
-            self._unique_cnames = sorted(self._unique_cnames, key=lambda s: s.get_rt())
-        sa_set, real_unique_devices = set(), list()
-        for raw in self._unique_cnames:
-            if raw.get_sa() not in sa_set:
-                real_unique_devices.append(raw)
-                sa_set.add(raw.get_sa())
-        self._unique_cnames = real_unique_devices
-
-    def _exclude_samsung_random_rawdata(self, all_rawdata_sniffers):
+        rawdata = self._get_result()
+        kept = self._exclude_samsung_random_rawdata(rawdata)
+        self._unique_cnames = rawdata.rows(kept & rawdata.cname_in(self.OUI_LIST)).first_seen()
+        if len(self._sniffer_id) == 1 and self._alg_version != 1:
+            # Algorithm ver1 needn't deal with random cnames.
+            self._random_cnames = rawdata.rows(kept & rawdata.cname_in(("Google_Random", None)) & (rawdata.pkt_type == 0))
+
+    def _exclude_samsung_random_rawdata(self, rawdata: RawdataColumns) -> np.ndarray:
         """
-        all_rawdatas format: [(rt, sa, cname, pkytype)]
+        rawdata is sorted by sa and rt. Return the mask of the rows to keep.
 
         The purpose of this function is to exclude samsung random rawdata.
         This function will do the following tasks:
-        1. Sort all rawdatas by sa and rt.
-        2. Filter all rawdata by pkt_type = 0.
-        3. Group rawdata by prefix of sa.
-        4. For each prefix group, find the samsung random sa case.
-        5. Delete all samsung random sa in rawdata.
+        1. Filter all rawdata by OUI cname and pkt_type = 0.
+        2. Group rawdata by prefix of sa.
+        3. For each prefix group, find the samsung random sa case.
+        4. Delete all samsung random sa in rawdata.
+        """
+        candidate = rawdata.cname_in(self.OUI_LIST) & (rawdata.pkt_type == 0)
+        sa, rt = rawdata.sa[candidate], rawdata.rt[candidate]
+        # sa seen more often than the number of sniffers is a real device.
+        _, inverse, counts = np.unique(sa, return_inverse=True, return_counts=True)
+        few = counts[inverse] <= len(self._sniffer_id)
+        final_excluded_sa = self._samsung_random_sa(sa[few], rt[few], 20*60*1000000)
+        return ~np.isin(rawdata.sa, final_excluded_sa)
+
+    @staticmethod
+    def _samsung_random_sa(sa: np.ndarray, rt: np.ndarray, window: int) -> np.ndarray:
         """
-        all_rawdatas = list()
-        for rd in all_rawdata_sniffers:
-            all_rawdatas.extend(rd)
-        all_rawdatas = sorted(all_rawdatas, key=lambda s: (s[1], s[0])) # s[1]: sa, s[0]: rt
-        excluded_random_rawdatas = all_rawdatas[:]
-        excluded_random_rawdatas = [rw for rw in excluded_random_rawdatas if rw[2] in self.OUI_LIST and rw[3] == 0]
-        mac_addr_prefix = set(map(lambda x:x[1][:6], excluded_random_rawdatas))
-        group_by_sa = [[y for y in excluded_random_rawdatas if y[1][:6] == x] for x in mac_addr_prefix]
-        final_excluded_sa = list()
-        for value, sa in zip(mac_addr_prefix, group_by_sa):
-            mac_addr_list = [s[1] for s in sa]
-            excluded_sa = [
-                mac_addr for mac_addr in mac_addr_list
-                if mac_addr_list.count(mac_addr) > len(self._sniffer_id)
-            ]
-            candidate_exclude_sas = [s for s in mac_addr_list if s not in excluded_sa]
-            sa = [s for s in sa if s[1] in candidate_exclude_sas]
-            for idx, s in enumerate(sa):
-                try:
-                    if sa[idx+4][0] - s[0] <= timedelta(minutes=20):
-                        final_excluded_sa.extend(candidate_exclude_sas)
-                        break
-                except IndexError:
-                    break
-        return [rw for rw in all_rawdatas if rw[1] not in final_excluded_sa]
+        sa (48-bit int) and rt (microseconds) are the candidate rows sorted by sa and rt.
+
+        Within a prefix group, 5 consecutive rows inside `window` mark every sa of the group as random.
+        """
+        prefix = mac_address.oui(sa)
+        in_window = (prefix[4:] == prefix[:-4]) & (rt[4:] - rt[:-4] <= window)
+        random_prefixes = np.unique(prefix[:-4][in_window])
+        return np.unique(sa[np.isin(prefix, random_prefixes)])
 
     def _calculate_hour_counts(self):
-        for raw in self._unique_cnames:
-            self._unique_period_counts[raw.get_rt().hour] += 1
+        self._unique_period_counts = self._unique_cnames.hour_counts()
         if self._alg_version == 1:
             # Algorithm ver1 needn't deal with random cnames.
             return
         if len(self._sniffer_id) == 1:
-            for raw in self._random_cnames:
-                self._random_period_counts[raw.get_rt().hour] += 1
+            self._random_period_counts = self._random_cnames.hour_counts()
         else:
             self._clear_random_cnames_for_multiple_sniffers()
 
@@ -162,7 +270,8 @@ class SiteWithSnifferInfo:
             res.append(round(final_count))
         return res
 
-    def _get_output_subsql(self):
+    def _get_output_rows(self) -> List[tuple]:
+        """(site_id, ts_hour, count) of the open hours to write. """
         output_list = list()
         ts = datetime.combine(self._start_date, datetime.min.time())
         if self._sp_dt:
@@ -177,45 +286,35 @@ class SiteWithSnifferInfo:
             hour_shift = 1 if self._closed_hour.minute == 0 else 0
         for idx, count in enumerate(self._get_final_customer_counts()):
             if self._open_hour.hour <= idx <= end_hour - hour_shift:
-                output_list.append(f"('{self._site_id}', '{ts}', {count})")
+                output_list.append((self._site_id, ts, count))
             ts += timedelta(hours=1)
-        return ",".join(output_list)
+        return output_list
 
     def _upsert_to_database(self):
-        output_str = self._get_output_subsql()
-        if not output_str:
-            return
-        sql = f"""SET session time zone 'Asia/Taipei';
-            INSERT INTO customer_count VALUES {output_str} ON CONFLICT (site_id, ts_hour) DO UPDATE SET count = EXCLUDED.count
-        """
-        sql = sql.replace('"', "")
-        self._conn.execute(sql)
-        self._conn.commit()
-
-    def _clear_random_cnames_for_multiple_sniffers(self):
-        sub_sql_a, sub_sql_b = self._get_sub_sql_stmt_for_random_count()
-        sql = f"""SET session time zone 'Asia/Taipei';
-            SELECT date_part('hour', coalesce(a.rt, b.rt))::int as time,
-                   count(1) AS AR_pkts -- Total
-            FROM
-            (
-                {sub_sql_a}
-            ) a
-            FULL JOIN
-            (
-                {sub_sql_b}
-            ) b
-            ON a.sa = b.sa
-            AND a.rt - b.rt BETWEEN interval '-00:01' AND interval '00:01'
-            GROUP BY 1
-            ORDER BY 1
-        """
-        res = self._conn.execute(sql)
-        result = res.fetchall()
-        for idx, random_count in result:
-            self._random_period_counts[idx] = random_count
-
-    def _get_sub_sql_stmt_for_random_count(self):
+        upsert_customer_counts(self._conn, [self._get_output_rows()])
+
+    def _clear_random_cnames_for_multiple_sniffers(self, start=None, end=None, count_from=None):
+        """Random counts per hour, of the hours from `count_from` on when it is given. """
+        sniffer_rows = self._get_random_rows(start, end)
+        counts = random_join_hour_counts(sniffer_rows, count_from=_to_us(count_from) if count_from is not None else None)
+        for idx, random_count in enumerate(counts):
+            if random_count:
+                self._random_period_counts[idx] = random_count
+
+    def _get_random_rows(self, start=None, end=None) -> List[RawdataInfo]:
+        """rt and sa of the random cname rows of every sniffer, streamed with one query. """
+        sql = " UNION ALL ".join(
+            f"SELECT {i}, {RawdataColumns.SELECT_RT_SA} FROM ({sub_sql}) AS s{i}"
+            for i, sub_sql in enumerate(self._get_sub_sql_stmt_for_random_count(start, end)))
+        chunks = []
+        for rows in stream_rows(self._conn, sql):
+            sniffer, rt, sa = zip(*rows)
+            chunks.append((np.array(sniffer, dtype=np.int64), np.array(rt, dtype=np.int64), mac_address.to_ints(sa, strict=False)))
+        sniffer, rt, sa = (np.concatenate(c) for c in zip(*chunks)) if chunks else [np.empty(0, dtype=np.int64)] * 3
+        # Rows whose sa is not 12 hex digits are dropped.
+        return [RawdataInfo(rt[(sniffer == i) & (sa >= 0)], sa[(sniffer == i) & (sa >= 0)]) for i in range(len(self._sniffer_id))]
+
+    def _get_sub_sql_stmt_for_random_count(self, start=None, end=None):
 
         template = """
             SELECT rt, sa FROM public.rawdata_{sniffer}
@@ -224,24 +323,216 @@ class SiteWithSnifferInfo:
             AND pkt_type = 0
             AND (cname IS NULL or cname = 'Google_Random')
         """
-        return [template.format(sniffer=sniffer, start_date=self._start_date, end_date=self._end_date, rssi=rssi)
+        start, end = start or self._start_date, end or self._end_date
+        return [template.format(sniffer=sniffer, start_date=start, end_date=end, rssi=rssi)
             for sniffer, rssi in zip(self._sniffer_id, self._rssi)
         ]
 
 
-def setup_logger(logger):
-    """Logger format setting"""
-    LOG_MSG_FORMAT = "[%(asctime)s][%(levelname)s] %(module)s %(funcName)s(): %(message)s"
-    LOG_FILENAME = "worker.log"
-    LOG_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
-    logging.basicConfig(level=logging.INFO, format=LOG_MSG_FORMAT, datefmt=LOG_TIME_FORMAT, filename=LOG_FILENAME)
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
 
 
-def worker_run_db_routine(specific_date: str):
-    setup_logger(logger)
-    engine = create_engine(os.environ['db_url'])
-    conn = next(db_session(engine))
-    res = conn.execute("""
+def _to_us(dt: datetime) -> int:
+    return (dt - _EPOCH) // timedelta(microseconds=1)
+
+
+def _from_us(us: int) -> datetime:
+    return _EPOCH + timedelta(microseconds=us)
+
+
+def _day_start(day: date) -> datetime:
+    """Midnight of `day` in TIME_ZONE. """
+    return pytz.timezone(TIME_ZONE).localize(datetime.combine(day, datetime.min.time()))
+
+
+class IncrementalSiteWithSnifferInfo(SiteWithSnifferInfo):
+    """
+    Intra-day SiteWithSnifferInfo that only reads the rawdata after its last run.
+
+    The state of a site is kept in `state_dir`/{site_id}.json: the first rt and hour of every
+    unique cname sa, the pkt_type 0 rows of the sa that can still be Samsung random ones, the
+    random counts per hour and the rt watermark. A run fetches the rows with
+    watermark < rt <= now - `settle` seconds, adds them to the state and upserts the counts of
+    the hours still open. Rows stored after the watermark passed their rt are not counted until the
+    nightly full run of the day (--days_ago 1 in main.py), which rewrites all its hours.
+    Multi-sniffer random counts are recomputed in SQL from the hour of the watermark on. The
+    state starts over on a new day or when the sniffers of the site change.
+
+    An hour is closed once the watermark is CLOSE_AFTER past its end. Its count is written once
+    more, and once that write is committed confirm_final_hours lists it in the state's final
+    hours, which later runs do not write again. A closed hour can still be off: whether an sa is
+    a Samsung random one depends on its rows of the whole day, so later rows can add or remove
+    it from the hour it was first seen in. The nightly full run rewrites the closed hours with
+    the counts of the whole day. With `recompute` the state starts over: the whole day is read
+    again and every hour rewritten, e.g. after the rawdata was corrected.
+    """
+
+    # Most changes to the count of an hour come from the 20 minute Samsung random window and the
+    # 1 minute multi-sniffer pairing, within this time. The day-wide exclusion can change it later,
+    # which is left to the nightly full run.
+    CLOSE_AFTER = timedelta(minutes=21)
+
+    def __init__(self, site_info: tuple, start_date: date, end_date: date, conn, state_dir: str, settle: int = 60,
+                 recompute: bool = False):
+        super().__init__(site_info, start_date, end_date, conn)
+        self._state_dir = state_dir
+        self._state_path = os.path.join(state_dir, f'{self._site_id}.json')
+        self._settle = settle
+        self._recompute = recompute
+        self._final_hours = set()
+
+    def compute(self) -> List[tuple]:
+        # The counts are recomputed from the whole state, so saving it before the upsert is
+        # safe: after a failed upsert the next run writes them again, its closing hours too.
+        state = self._new_state() if self._recompute else self._load_state()
+        day_end = _day_start(self._end_date)
+        until = min(datetime.now(timezone.utc) - timedelta(seconds=self._settle), day_end)
+        watermark = _from_us(state['watermark']) if state['watermark'] is not None else None
+        if watermark is None or watermark < until:
+            self._update_state(state, self._get_result(watermark, until))
+            if self._alg_version != 1 and len(self._sniffer_id) > 1:
+                self._update_multiple_sniffers_random_counts(state, watermark, until)
+            state['watermark'] = _to_us(until)
+        self._final_hours = set(state.setdefault('final_hours', []))
+        state['closing_hours'] = [h for h in self._closed_hours(_from_us(state['watermark'])) if h not in self._final_hours]
+        self._save_state(state)
+        self._calculate_state_counts(state)
+        return self._get_output_rows()
+
+    def _closed_hours(self, watermark: datetime) -> range:
+        day_start = _day_start(self._start_date)
+        if watermark >= _day_start(self._end_date):
+            return range(24)
+        return range(max(0, min(24, (watermark - day_start - self.CLOSE_AFTER) // timedelta(hours=1))))
+
+    def _get_output_rows(self) -> List[tuple]:
+        return [row for row in super()._get_output_rows() if row[1].hour not in self._final_hours]
+
+    def _upsert_to_database(self):
+        super()._upsert_to_database()
+        self.confirm_final_hours(self._state_dir, self._site_id)
+
+    @staticmethod
+    def confirm_final_hours(state_dir: str, site_id: str):
+        """Move the closing hours of the site's last run to its final hours, after its rows are committed. """
+        state_path = os.path.join(state_dir, f'{site_id}.json')
+        with open(state_path) as f:
+            state = json.load(f)
+        if not state.get('closing_hours'):
+            return
+        state['final_hours'] = sorted(state['final_hours'] + state['closing_hours'])
+        state['closing_hours'] = []
+        with open(state_path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(state_path + '.tmp', state_path)
+
+    def _state_key(self):
+        return {
+            'date': str(self._start_date),
+            'alg_version': self._alg_version,
+            'sniffers': [list(s) for s in sorted(zip(self._sniffer_id, self._rssi))],
+        }
+
+    def _load_state(self):
+        try:
+            with open(self._state_path) as f:
+                state = json.load(f)
+            if state.get('key') == self._state_key():
+                return state
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            logger.warning(f"Unreadable state {self._state_path}, starting over: {e}")
+        return self._new_state()
+
+    def _new_state(self):
+        return {'key': self._state_key(), 'watermark': None, 'first_seen': {}, 'probes': {}, 'random_counts': [0]*24,
+                'final_hours': [], 'closing_hours': []}
+
+    def _save_state(self, state):
+        os.makedirs(self._state_dir, exist_ok=True)
+        with open(self._state_path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(self._state_path + '.tmp', self._state_path)
+
+    def _update_state(self, state, rawdata: RawdataColumns):
+        """
+        first_seen: {sa: [rt, hour]} of the earliest row of every unique cname sa.
+        probes: {sa: [rt, ...]} of its pkt_type 0 rows, None once it has more than one per sniffer.
+        """
+        first_seen, probes, random_counts = state['first_seen'], state['probes'], state['random_counts']
+        sniffer_count = len(self._sniffer_id)
+        oui = rawdata.cname_in(self.OUI_LIST)
+        unique = rawdata.rows(oui).first_seen()
+        for sa, us, hour in zip(unique.sa.tolist(), unique.rt.tolist(), _hours(unique.rt).tolist()):
+            sa = mac_address.to_str(sa)
+            seen = first_seen.get(sa)
+            if seen is None or us < seen[0]:
+                first_seen[sa] = [us, hour]
+        probe = rawdata.rows(oui & (rawdata.pkt_type == 0))
+        for sa, us in zip(probe.sa.tolist(), probe.rt.tolist()):
+            sa = mac_address.to_str(sa)
+            rts = probes.setdefault(sa, [])
+            if rts is not None:
+                rts.append(us)
+                if len(rts) > sniffer_count:
+                    probes[sa] = None
+        if self._alg_version != 1 and sniffer_count == 1:
+            random = rawdata.rows(rawdata.cname_in(("Google_Random", None)) & (rawdata.pkt_type == 0))
+            for hour, count in enumerate(random.hour_counts()):
+                random_counts[hour] += count
+
+    def _calculate_state_counts(self, state):
+        candidates = [(sa, us) for sa, rts in state['probes'].items() if rts is not None for us in rts]
+        excluded_sa = set()
+        if candidates:
+            sa, rt = zip(*candidates)
+            sa, rt = mac_address.to_ints(sa), np.array(rt, dtype=np.int64)
+            order = np.lexsort((rt, sa))
+            excluded_sa = set(mac_address.to_strs(self._samsung_random_sa(sa[order], rt[order], 20*60*1000000)))
+        for sa, (_, hour) in state['first_seen'].items():
+            if sa not in excluded_sa:
+                self._unique_period_counts[hour] += 1
+        self._random_period_counts = list(state['random_counts'])
+
+    def _update_multiple_sniffers_random_counts(self, state, watermark, until):
+        # A row can pair with rows up to 1 minute earlier, so the hour of watermark - 1 minute
+        # is recomputed, reading 1 more minute before it.
+        day_start = _day_start(self._start_date)
+        count_from = day_start
+        if watermark is not None:
+            local = (watermark - timedelta(minutes=1)).astimezone(pytz.timezone(TIME_ZONE))
+            count_from = max(day_start, local.replace(minute=0, second=0, microsecond=0))
+        self._random_period_counts = state['random_counts'][:count_from.hour] + [0]*(24-count_from.hour)
+        self._clear_random_cnames_for_multiple_sniffers(max(day_start, count_from - timedelta(minutes=1)), until, count_from)
+        state['random_counts'] = list(self._random_period_counts)
+
+
+def upsert_customer_counts(conn, outputs: Iterable[List[tuple]]):
+    """
+    Upsert the (site_id, ts_hour, count) rows of several sites with one statement and one commit.
+
+    The rows are COPYed into a temporary table first, so no value is written into the SQL.
+    """
+    rows = [row for output in outputs if output for row in output]
+    if not rows:
+        return
+    data = io.StringIO()
+    csv.writer(data).writerows(rows)
+    data.seek(0)
+    cursor = conn.connection().connection.cursor()
+    # count is numeric, so algorithm ver1's fractional counts round on the insert as before.
+    cursor.execute(f"""SET SESSION time zone '{TIME_ZONE}';
+        CREATE TEMPORARY TABLE customer_count_stage ON COMMIT DROP AS
+            SELECT site_id, ts_hour, count::numeric AS count FROM customer_count WITH NO DATA""")
+    cursor.copy_expert("COPY customer_count_stage FROM STDIN WITH (FORMAT csv)", data)
+    cursor.execute("""INSERT INTO customer_count (site_id, ts_hour, count)
+        SELECT site_id, ts_hour, count FROM customer_count_stage
+        ON CONFLICT (site_id, ts_hour) DO UPDATE SET count = EXCLUDED.count""")
+    conn.commit()
+
+
+SITE_INFO_SQL = """
     SET session time zone 'Asia/Taipei';
     SELECT si_i.site_id, si_i.open_hour, si_i.closed_hour, si_i.open_hour_wend, si_i.closed_hour_wend,
            si_i.alg_version, si_i.android_rate, si_i.wifi_rate, si_i.alg_params, sn_i.sniffer_id, sn_i.rssi
@@ -249,32 +540,184 @@ def worker_run_db_routine(specific_date: str):
            INNER JOIN (SELECT site_id, array_agg(sniffer_id) AS sniffer_id, array_agg(rssi) AS rssi FROM sniffer_info
                        WHERE is_active GROUP BY site_id)
            AS sn_i ON si_i.site_id = sn_i.site_id
-    """)
-    a = res.fetchall()
-    l = []
+"""
+
+DEFAULT_STATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'incremental_state')
+DEFAULT_BACKFILL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backfill_state')
+
+# Engines of the site workers by process and db_url. A pool process creates its own on its first
+# site, rather than reusing the connections of the engine it inherits from its parent.
+_engines = dict()
+
+
+def _site_engine(db_url: str, pool_size: int = 1):
+    key = (os.getpid(), db_url)
+    if key not in _engines:
+        _engines[key] = create_engine(db_url, pool_size=pool_size)
+    return _engines[key]
+
+
+def _compute_site(db_url: str, site_info: tuple, start_date: date, end_date: date, sp_dt: bool, state_dir,
+                  settle: int, recompute: bool = False):
+    """Compute one site on its own connection of _site_engine(db_url). None when the site failed. """
+    start_time = time.time()
+    conn = next(db_session(_site_engine(db_url)))
+    try:
+        if state_dir is not None:
+            proc = IncrementalSiteWithSnifferInfo(site_info, start_date, end_date, conn, state_dir, settle, recompute)
+        else:
+            proc = SiteWithSnifferInfo(site_info, start_date, end_date, conn, sp_dt=sp_dt)
+        output = proc.compute()
+    except Exception as e:
+        logger.exception(f"Site {site_info[0]} failed: {e}")
+        return None
+    finally:
+        conn.close()
+    logger.info(f"Site {site_info[0]} ({len(site_info[9])} sniffers): {time.time()-start_time:.2f} s")
+    return output
+
+
+def _compute_sites(args: List[tuple], workers: int, executor: str):
+    """(args, output) of _compute_site(*args) for every args, as they finish. """
+    if workers <= 1 or not args:
+        for a in args:
+            yield a, _compute_site(*a)
+        return
+    if executor == 'process':
+        pool = ProcessPoolExecutor(workers)
+    else:
+        pool = ThreadPoolExecutor(workers)
+    with pool:
+        futures = {pool.submit(_compute_site, *a): a for a in args}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+def run_sites(db_url: str, site_infos: List[tuple], start_date: date, end_date: date, sp_dt=False,
+              state_dir=None, settle=60, workers=1, executor='thread', recompute=False):
+    """
+    Compute every site on `workers` threads or processes and upsert all of them at the end.
+
+    Each site runs on its own pooled connection. With `state_dir` the sites run incrementally,
+    and the hours they closed are confirmed final after the upsert.
+    """
+    start_time = time.time()
+    args = [(db_url, i, start_date, end_date, sp_dt, state_dir, settle, recompute) for i in site_infos]
+    engine = _site_engine(db_url, workers if executor == 'thread' else 1)
+    results = list(_compute_sites(args, workers, executor))
+    outputs = [output for _, output in results]
+    compute_time = time.time()
+    conn = next(db_session(engine))
+    try:
+        upsert_customer_counts(conn, outputs)
+    finally:
+        conn.close()
+    if state_dir is not None:
+        for (_, site_info, *_), output in results:
+            if output is not None:
+                IncrementalSiteWithSnifferInfo.confirm_final_hours(state_dir, site_info[0])
+    failed = sum(o is None for o in outputs)
+    logger.info(f"{len(site_infos)} sites ({failed} failed) on {workers} {executor} workers: "
+                f"compute {compute_time-start_time:.2f} s, upsert {time.time()-compute_time:.2f} s")
+
+
+def run_date_range(db_url: str, site_infos: List[tuple], start_date: date, end_date: date,
+                   checkpoint_path: str, workers=1, executor='thread'):
+    """
+    Recompute every site on every date from start_date to end_date, both included.
+
+    The (site, date) grid is spread over `workers`; a date is upserted with one statement once all
+    its sites are done. Dates without failed sites are listed in `checkpoint_path`, which a
+    restarted run skips. The file stays once the whole range is done, so the same range submitted
+    again does nothing; remove it to recompute the range.
+    """
+    start_time = time.time()
+    try:
+        with open(checkpoint_path) as f:
+            done = set(json.load(f))
+    except FileNotFoundError:
+        done = set()
+    dates = [start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+    dates = [d for d in dates if str(d) not in done]
+    if not dates:
+        logger.info(f"{checkpoint_path}: every date is done already.")
+        return
+    if done:
+        logger.info(f"Resuming {checkpoint_path}: {len(done)} dates done, {len(dates)} to go.")
+    args = [(db_url, i, d, d+timedelta(days=1), True, None, 0) for d in dates for i in site_infos]
+    remaining = {d: len(site_infos) for d in dates}
+    outputs = defaultdict(list)
+    engine = _site_engine(db_url, workers if executor == 'thread' else 1)
+    for (_, _, dt, *_), output in _compute_sites(args, workers, executor):
+        outputs[dt].append(output)
+        remaining[dt] -= 1
+        if remaining[dt]:
+            continue
+        date_outputs = outputs.pop(dt)
+        conn = next(db_session(engine))
+        try:
+            upsert_customer_counts(conn, date_outputs)
+        finally:
+            conn.close()
+        failed = sum(o is None for o in date_outputs)
+        if failed:
+            logger.warning(f"{dt}: {failed} of {len(site_infos)} sites failed, the date is not checkpointed.")
+            continue
+        done.add(str(dt))
+        os.makedirs(os.path.dirname(checkpoint_path) or '.', exist_ok=True)
+        with open(checkpoint_path + '.tmp', 'w') as f:
+            json.dump(sorted(done), f)
+        os.replace(checkpoint_path + '.tmp', checkpoint_path)
+        logger.info(f"{dt}: {len(site_infos)} sites upserted, {len(done)} dates done.")
+    logger.info(f"{len(dates)} dates x {len(site_infos)} sites on {workers} {executor} workers: {time.time()-start_time:.2f} s")
+
+
+def setup_logger(logger):
+    """Logger format setting"""
+    LOG_MSG_FORMAT = "[%(asctime)s][%(levelname)s] %(module)s %(funcName)s(): %(message)s"
+    LOG_FILENAME = "worker.log"
+    LOG_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+    logging.basicConfig(level=logging.INFO, format=LOG_MSG_FORMAT, datefmt=LOG_TIME_FORMAT, filename=LOG_FILENAME)
+
+
+def read_site_infos(db_url: str, site_ids: List[str] = None) -> List[tuple]:
+    site_infos = site_config.fetch_all(SITE_INFO_SQL, db_url)
+    if site_ids:
+        site_infos = [i for i in site_infos if i[0] in site_ids]
+        missing = set(site_ids) - {i[0] for i in site_infos}
+        if missing:
+            logger.warning(f"No active sniffer for sites {sorted(missing)}.")
+    return site_infos
+
+
+def worker_run_db_routine(specific_date: str, workers: int = 1, executor: str = 'thread'):
+    setup_logger(logger)
+    db_url = os.environ['db_url']
     dt = datetime.strptime(specific_date, '%Y-%m-%d').date()
-    for i in a:
-        l.append(SiteWithSnifferInfo(i, dt, dt+timedelta(days=1), conn, sp_dt=True))
-    for x in l:
-        x.main_proc()
-    conn.close()
+    run_sites(db_url, read_site_infos(db_url), dt, dt+timedelta(days=1), sp_dt=True, workers=workers, executor=executor)
+
+
+def worker_run_db_routine_range(start_date: str, end_date: str, site_ids: List[str] = None, workers: int = 4,
+                                 executor: str = 'thread', checkpoint_dir: str = DEFAULT_BACKFILL_DIR):
+    """
+    Backfill customer_count from start_date to end_date (YYYY-MM-DD, both included).
+
+    A run of the same range and sites resumes from its checkpoint in `checkpoint_dir`.
+    """
+    setup_logger(logger)
+    db_url = os.environ['db_url']
+    sites = hashlib.md5(','.join(sorted(site_ids)).encode()).hexdigest()[:8] if site_ids else 'all'
+    checkpoint_path = os.path.join(checkpoint_dir, f'{start_date}_{end_date}_{sites}.json')
+    run_date_range(db_url, read_site_infos(db_url, site_ids), datetime.strptime(start_date, '%Y-%m-%d').date(),
+                   datetime.strptime(end_date, '%Y-%m-%d').date(), checkpoint_path, workers, executor)
 
 
 def worker_run_db_routine_one_site(specific_date: str, site_id: str):
     setup_logger(logger)
-    engine = create_engine(os.environ['db_url'])
+    db_url = os.environ['db_url']
+    site_info = read_site_infos(db_url, [site_id])[0]
+    engine = create_engine(db_url)
     conn = next(db_session(engine))
-    res = conn.execute(f"""
-    SET session time zone 'Asia/Taipei';
-    SELECT si_i.site_id, si_i.open_hour, si_i.closed_hour, si_i.open_hour_wend, si_i.closed_hour_wend,
-           si_i.alg_version, si_i.android_rate, si_i.wifi_rate, si_i.alg_params, sn_i.sniffer_id, sn_i.rssi
-           FROM site_info AS si_i
-           INNER JOIN (SELECT site_id, array_agg(sniffer_id) AS sniffer_id, array_agg(rssi) AS rssi FROM sniffer_info
-                       WHERE is_active GROUP BY site_id)
-           AS sn_i ON si_i.site_id = sn_i.site_id
-    WHERE si_i.site_id = '{site_id}'
-    """)
-    site_info = res.fetchone()
     dt = datetime.strptime(specific_date, '%Y-%m-%d').date()
     proc = SiteWithSnifferInfo(site_info, dt, dt+timedelta(days=1), conn, sp_dt=True)
     proc.main_proc()
@@ -282,26 +725,31 @@ def worker_run_db_routine_one_site(specific_date: str, site_id: str):
 
 
 if __name__ == '__main__':
-    setup_logger(logger)
-    engine = create_engine(os.environ['db_url'])
-
-    start_time = time.time()
-    conn = next(db_session(engine))
-    res = conn.execute("""
-    SET session time zone 'Asia/Taipei';
-    SELECT si_i.site_id, si_i.open_hour, si_i.closed_hour, si_i.open_hour_wend, si_i.closed_hour_wend,
-           si_i.alg_version, si_i.android_rate, si_i.wifi_rate, si_i.alg_params, sn_i.sniffer_id, sn_i.rssi
-           FROM site_info AS si_i
-           INNER JOIN (SELECT site_id, array_agg(sniffer_id) AS sniffer_id, array_agg(rssi) AS rssi FROM sniffer_info
-                       WHERE is_active GROUP BY site_id)
-           AS sn_i ON si_i.site_id = sn_i.site_id
-    """)
-    a = res.fetchall()
-    l = []
-    for i in a:
-        l.append(SiteWithSnifferInfo(i, date.today(), date.today()+timedelta(days=1), conn))
-    for x in l:
-        x.main_proc()
-    end_time = time.time()
-    conn.close()
-    logger.info(f"Execution time: {end_time-start_time}")
+    @click.command()
+    @click.option('--incremental', is_flag=True, help='Only read the rawdata after the last run, keeping per-site state in --state_dir.')
+    @click.option('--state_dir', default=DEFAULT_STATE_DIR, help='Directory of the per-site state of --incremental.')
+    @click.option('--settle', default=60, help='Seconds before now that --incremental leaves for rawdata still on its way.')
+    @click.option('--workers', default=1, help='Sites computed at once, each on its own database connection.')
+    @click.option('--executor', default='thread', type=click.Choice(['thread', 'process']), help='Run the --workers as threads or processes.')
+    @click.option('--recompute', is_flag=True, help='With --incremental, read the whole day again and rewrite its closed hours too.')
+    @click.option('--start_date', default=None, help='Backfill from this date instead, e.g. 2021-09-01.')
+    @click.option('--end_date', default=None, help='Last date of --start_date, default the same date.')
+    @click.option('--site_id', multiple=True, help='Sites of --start_date, default all. Repeat for more sites.')
+    @click.option('--days_ago', default=None, type=int, help='Recount the whole day this many days ago, e.g. 1 for yesterday.')
+    def run(incremental, state_dir, settle, workers, executor, recompute, start_date, end_date, site_id, days_ago):
+        if start_date:
+            worker_run_db_routine_range(start_date, end_date or start_date, list(site_id), workers, executor)
+            return
+        if days_ago is not None:
+            worker_run_db_routine(str(date.today() - timedelta(days=days_ago)), workers, executor)
+            return
+        setup_logger(logger)
+        db_url = os.environ['db_url']
+        start_time = time.time()
+        run_sites(db_url, read_site_infos(db_url), date.today(), date.today()+timedelta(days=1),
+                  state_dir=state_dir if incremental else None, settle=settle, workers=workers, executor=executor,
+                  recompute=recompute)
+        end_time = time.time()
+        logger.info(f"Execution time: {end_time-start_time}")
+
+    run()
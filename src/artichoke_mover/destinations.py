@@ -0,0 +1,129 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import os
+import re
+import logging
+import configparser
+
+import paho.mqtt.client as mqtt
+
+from forwarder import Forwarder
+from store import DiskQueue
+
+logger = logging.getLogger(__name__)
+
+SECTION_PREFIX = 'destination:'
+
+
+def compile_topic_filters(filters):
+    """One regex matching a topic against any of the MQTT topic filters (+ and # wildcards). """
+    patterns = []
+    for topic_filter in filters:
+        levels = topic_filter.split('/')
+        parts = []
+        for i, level in enumerate(levels):
+            if level == '#' and i == len(levels) - 1:
+                # 'a/#' also matches 'a' itself.
+                if parts:
+                    parts[-1] += '(?:/.*)?'
+                else:
+                    parts.append('.*')
+                break
+            parts.append('[^/]*' if level == '+' else re.escape(level))
+        patterns.append('/'.join(parts))
+    return re.compile('(?:{})$'.format('|'.join(patterns)))
+
+
+class Destination(object):
+    """
+    A destination broker and the topics it gets.
+
+    A message is sent when its topic matches one of `topics` and, with a
+    `sniffers` allowlist, when the last topic level is one of the listed
+    sniffers.
+    """
+
+    def __init__(self, name, forwarder, topics=('#',), sniffers=None):
+        self.name = name
+        self.forwarder = forwarder
+        self.topics = tuple(topics)
+        self.sniffers = frozenset(s.replace(':', '').lower() for s in sniffers) if sniffers else None
+        self._topic_regex = compile_topic_filters(self.topics)
+
+    def matches(self, topic):
+        if self.sniffers is not None and topic.rpartition('/')[2] not in self.sniffers:
+            return False
+        return self._topic_regex.match(topic) is not None
+
+
+class Router(object):
+    """
+    Fan a message out to the destinations that match its topic.
+
+    Artichoke topics are one per sniffer, so the matching destinations of a
+    topic are computed once and cached.
+    """
+
+    def __init__(self, destinations):
+        self.destinations = destinations
+        self._routes = {}
+
+    def route(self, topic):
+        forwarders = self._routes.get(topic)
+        if forwarders is None:
+            forwarders = self._routes[topic] = tuple(
+                d.forwarder for d in self.destinations if d.matches(topic))
+        return forwarders
+
+    def put(self, topic, payload):
+        for forwarder in self.route(topic):
+            forwarder.put(topic, payload)
+
+
+def _split(value):
+    return [v.strip() for v in value.replace('\n', ',').split(',') if v.strip()]
+
+
+def load_destinations(path, client_name, defaults):
+    """
+    Destinations of an INI file, one [destination:<name>] section each.
+
+    `defaults` are the Forwarder settings of the command line, which a
+    section can override. With defaults['store_dir'], each destination
+    forwards from its own DiskQueue in store_dir/<name>.
+    """
+    config = configparser.ConfigParser()
+    if not config.read(path):
+        raise FileNotFoundError(path)
+
+    destinations = []
+    for section in config.sections():
+        if not section.startswith(SECTION_PREFIX):
+            continue
+        name = section[len(SECTION_PREFIX):]
+        options = config[section]
+        client = mqtt.Client(f'{client_name}_{name}')
+        if options.get('username') and options.get('password'):
+            client.username_pw_set(options['username'], options['password'])
+        client.connect_async(options['host'], options.getint('port', 1883))
+        store = None
+        if defaults.get('store_dir'):
+            store = DiskQueue(os.path.join(defaults['store_dir'], name), defaults['store_segment_mb'] * 1024 * 1024)
+        forwarder = Forwarder(
+            client, name,
+            queue_size=options.getint('queue_size', defaults['queue_size']),
+            max_inflight=options.getint('max_inflight', defaults['max_inflight']),
+            coalesce=options.getint('coalesce', defaults['coalesce']),
+            coalesce_interval=options.getint('coalesce_interval', defaults['coalesce_interval']) / 1000.0,
+            report_interval=defaults['report_interval'],
+            store=store,
+            drain_rate=options.getint('drain_rate', defaults.get('drain_rate', 0)),
+            compress=options.get('compress', defaults.get('compress')) or None)
+        destination = Destination(name, forwarder, _split(options.get('topics', '#')),
+                                  _split(options.get('sniffers', '')))
+        logger.info(f'Destination {name}: {options["host"]}, topics {list(destination.topics)}, '
+                    f'sniffers {sorted(destination.sniffers) if destination.sniffers else "all"}.')
+        destinations.append(destination)
+    if not destinations:
+        raise ValueError(f'No [{SECTION_PREFIX}<name>] section in {path}.')
+    return destinations
@@ -0,0 +1,235 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import time
+import zlib
+import queue
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+# Compressed messages start with the magic and a codec byte; JSON never starts with NUL.
+ENVELOPE_MAGIC = b'\x00ART'
+
+
+def envelope(payloads):
+    """Several JSON payloads of one topic as one JSON array message. """
+    return b'[' + b','.join(payloads) + b']'
+
+
+def compressor(codec):
+    """A function that compresses a message with `codec` ('zlib' or 'zstd') for mqtt_sub_postgres. """
+    if codec == 'zlib':
+        return lambda data: ENVELOPE_MAGIC + b'z' + zlib.compress(data, 6)
+    if codec == 'zstd':
+        import zstandard
+        zstd = zstandard.ZstdCompressor(level=3)
+        return lambda data: ENVELOPE_MAGIC + b's' + zstd.compress(data)
+    raise ValueError(f'Unknown compression {codec}.')
+
+
+class Forwarder(object):
+    """
+    Republish the received messages to one destination from a publisher thread.
+
+    The subscriber callback only calls put(). Messages wait in a queue of
+    `queue_size`; when it is full put() blocks the subscriber loop, so the
+    source broker holds the backlog instead of the mover. At most
+    `max_inflight` QoS1 messages wait for their PUBACK, and the publisher
+    thread waits for a free slot instead of letting paho queue without limit.
+
+    With `coalesce`, up to that many payloads of a topic are sent as one
+    JSON array envelope, flushed after `coalesce_interval` seconds at the
+    latest. mqtt_sub_postgres decodes both forms.
+
+    With a `store` (store.DiskQueue), put() appends to disk instead of the
+    queue and never blocks; the publisher thread reads the log and commits
+    its checkpoint up to the oldest message without PUBACK. `drain_rate`
+    caps the payloads published per second, so a backlog left by an outage
+    drains without flooding the destination.
+
+    With `compress` ('zlib', or 'zstd' with the zstandard package), every
+    published message, envelope or single payload, is compressed.
+    """
+
+    def __init__(self, client, name, queue_size=10000, max_inflight=20, coalesce=0, coalesce_interval=0.2,
+                 report_interval=60, store=None, drain_rate=0, compress=None):
+        self.client = client
+        self.name = name
+        self.queue_size = queue_size
+        self.max_inflight = max_inflight
+        self.coalesce = coalesce
+        self.coalesce_interval = coalesce_interval
+        self.report_interval = report_interval
+        self.store = store
+        self.drain_rate = drain_rate
+        self.compress = compress
+        self._compress = compressor(compress) if compress else None
+        self.queue = queue.Queue(maxsize=queue_size)
+        self._window = threading.Semaphore(max_inflight)
+        self._lock = threading.Lock()
+        self._pending = OrderedDict()
+        self.inflight = 0
+        self._next_publish = 0.0
+
+        # Delivery tracking of the store: read number -> [position, acked], in read order.
+        self._read_count = 0
+        self._unacked = OrderedDict()
+        self._mids = {}
+        self._early_acks = {}
+        self._delivered = None
+        self._last_commit = time.time()
+
+        # Counters
+        self.received = 0
+        self.published = 0
+        self.payloads_published = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.full_count = 0
+
+        client.max_inflight_messages_set(max_inflight)
+        client.on_publish = self._on_publish
+
+    def put(self, topic, payload):
+        self.received += 1
+        if self.store is not None:
+            self.store.append(topic, payload)
+            return
+        try:
+            self.queue.put_nowait((topic, payload))
+        except queue.Full:
+            self.full_count += 1
+            self.queue.put((topic, payload))
+
+    def start(self):
+        threading.Thread(target=self._run, name=f'Publisher-{self.name}', daemon=True).start()
+        threading.Thread(target=self._run_reporter, name=f'Reporter-{self.name}', daemon=True).start()
+        logger.info(f'Forwarding to {self.name}: queue {self.queue_size}, {self.max_inflight} in flight, '
+                    f'coalesce {self.coalesce or "off"}, compress {self.compress or "off"}.')
+
+    def _run(self):
+        while True:
+            topic, payload, number = self._next(self._timeout())
+            if topic is not None:
+                if self.coalesce:
+                    self._add(topic, payload, number)
+                else:
+                    self._publish(topic, payload, [number])
+            if self._pending:
+                self._flush_due()
+            if self.store is not None and time.time() - self._last_commit >= 1.0:
+                self._commit()
+
+    def _next(self, timeout):
+        if self.store is None:
+            try:
+                topic, payload = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                return None, None, None
+            return topic, payload, None
+        record = self.store.read(timeout)
+        if record is None:
+            return None, None, None
+        topic, payload, position = record
+        with self._lock:
+            number = self._read_count
+            self._read_count += 1
+            self._unacked[number] = [position, False]
+        return topic, payload, number
+
+    def _commit(self):
+        with self._lock:
+            delivered = self._delivered
+        self.store.commit(delivered)
+        self._last_commit = time.time()
+
+    def _timeout(self):
+        if not self._pending:
+            return 1.0
+        oldest = next(iter(self._pending.values()))[0]
+        return max(0.0, oldest + self.coalesce_interval - time.time())
+
+    def _add(self, topic, payload, number):
+        pending = self._pending.get(topic)
+        if pending is None:
+            pending = self._pending[topic] = (time.time(), [], [])
+        pending[1].append(payload)
+        pending[2].append(number)
+        if len(pending[1]) >= self.coalesce:
+            del self._pending[topic]
+            self._publish(topic, envelope(pending[1]), pending[2])
+
+    def _flush_due(self):
+        deadline = time.time() - self.coalesce_interval
+        while self._pending:
+            topic, (since, payloads, numbers) = next(iter(self._pending.items()))
+            if since > deadline:
+                return
+            del self._pending[topic]
+            self._publish(topic, envelope(payloads), numbers)
+
+    def _publish(self, topic, payload, numbers):
+        if self.drain_rate:
+            now = time.time()
+            if self._next_publish > now:
+                time.sleep(self._next_publish - now)
+            self._next_publish = max(self._next_publish, now) + len(numbers) / self.drain_rate
+        self.bytes_in += len(payload)
+        if self._compress:
+            payload = self._compress(payload)
+        self.bytes_out += len(payload)
+        self._window.acquire()
+        with self._lock:
+            self.inflight += 1
+        # Without a connection paho keeps the QoS1 message and sends it after reconnecting.
+        # paho calls on_publish under its own lock, so self._lock is not held here.
+        info = self.client.publish(topic, payload, qos=1)
+        if self.store is not None:
+            with self._lock:
+                if self._early_acks.pop(info.mid, None):
+                    self._acked(numbers)
+                else:
+                    self._mids[info.mid] = numbers
+        self.published += 1
+        self.payloads_published += len(numbers)
+
+    def _on_publish(self, client, userdata, mid):
+        with self._lock:
+            self.inflight -= 1
+            if self.store is not None:
+                numbers = self._mids.pop(mid, None)
+                if numbers is None:
+                    # The PUBACK beat publish() returning the mid.
+                    self._early_acks[mid] = True
+                else:
+                    self._acked(numbers)
+        self._window.release()
+
+    def _acked(self, numbers):
+        for number in numbers:
+            self._unacked[number][1] = True
+        while self._unacked:
+            number, (position, acked) = next(iter(self._unacked.items()))
+            if not acked:
+                break
+            del self._unacked[number]
+            self._delivered = position
+
+    def _run_reporter(self):
+        last = (time.time(), self.received, self.published, self.payloads_published)
+        while True:
+            time.sleep(self.report_interval)
+            now = (time.time(), self.received, self.published, self.payloads_published)
+            elapsed = now[0] - last[0]
+            in_rate, out_rate, payload_rate = ((n - l) / elapsed for n, l in zip(now[1:], last[1:]))
+            last = now
+            if self.store is not None:
+                backlog = f'store backlog {self.store.backlog_bytes()} bytes'
+            else:
+                backlog = f'queue {self.queue.qsize()}/{self.queue_size} (full {self.full_count} times)'
+            ratio = f', compressed to {self.bytes_out / self.bytes_in:.0%}' if self.compress and self.bytes_in else ''
+            logger.info(f'{self.name}: in {in_rate:.0f} msg/s, out {out_rate:.0f} msg/s ({payload_rate:.0f} payloads/s), '
+                        f'{backlog}, in flight {self.inflight}/{self.max_inflight}{ratio}.')
@@ -1,5 +1,6 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
+import os
 import logging
 import paho.mqtt.subscribe as subscribe
 import time
@@ -7,7 +8,11 @@ import time
 import click
 import paho.mqtt.client as mqtt
 
-__version__ = 'v1.1.0'
+from forwarder import Forwarder
+from store import DiskQueue
+from destinations import Router, load_destinations
+
+__version__ = 'v1.2.0'
 
 logger = logging.getLogger(__name__)
 
@@ -24,18 +29,65 @@ def subscriber(mqtt_from, client_name):
     return client_sub
 
 
-def main(mqtt_from, to_mqtt, mqtt_topic, client_name=None):
+def main(mqtt_from, to_mqtt, mqtt_topic, client_name=None, queue_size=0, max_inflight=20, coalesce=0,
+         coalesce_interval=200, report_interval=60, destinations=None, store_dir=None, store_segment_mb=64,
+         drain_rate=0, compress=None):
+    """
+    Copy mqtt_topic from mqtt_from to to_mqtt, or to every destination of
+    the `destinations` INI file whose filters match, over one subscription.
+
+    With store_dir, every destination forwards from a disk log under
+    store_dir/<destination> and survives outages and restarts.
+    """
     client_name = client_name or f'artichoke_mover_{__version__}'
+    client_subscriber = subscriber(mqtt_from, client_name)
+
+    if destinations:
+        logger.info(f'Mover task from {mqtt_from}-[{mqtt_topic}] to the destinations of {destinations}.')
+        router = Router(load_destinations(destinations, client_name, {
+            'queue_size': queue_size or 10000,
+            'max_inflight': max_inflight,
+            'coalesce': coalesce,
+            'coalesce_interval': coalesce_interval,
+            'report_interval': report_interval,
+            'store_dir': store_dir,
+            'store_segment_mb': store_segment_mb,
+            'drain_rate': drain_rate,
+            'compress': compress,
+        }))
+        for destination in router.destinations:
+            destination.forwarder.client.loop_start()
+            destination.forwarder.start()
+        return run_subscriber(client_subscriber, mqtt_from, mqtt_topic, router.put)
 
     logger.info(f'Mover task from {mqtt_from}-[{mqtt_topic}] to {to_mqtt}.')
     client_publisher = publisher(to_mqtt, client_name)
-    client_subscriber = subscriber(mqtt_from, client_name)
 
+    forwarder = None
+    if store_dir:
+        store = DiskQueue(os.path.join(store_dir, to_mqtt), store_segment_mb * 1024 * 1024)
+        forwarder = Forwarder(client_publisher, to_mqtt, queue_size, max_inflight, coalesce,
+                              coalesce_interval / 1000.0, report_interval, store, drain_rate, compress)
+        forwarder.start()
+    elif queue_size > 0 or compress:
+        forwarder = Forwarder(client_publisher, to_mqtt, queue_size or 10000, max_inflight, coalesce,
+                              coalesce_interval / 1000.0, report_interval, compress=compress)
+        forwarder.start()
+
+    def republish(topic, data):
+        if forwarder:
+            forwarder.put(topic, data)
+        else:
+            client_publisher.publish(topic, data, qos=1)
+
+    client_publisher.loop_start()
+    run_subscriber(client_subscriber, mqtt_from, mqtt_topic, republish)
+
+
+def run_subscriber(client_subscriber, mqtt_from, mqtt_topic, republish):
     # The callback for when a PUBLISH message is received from the server.
     def on_message_wifi_packets_sub(client, userdata, msg):
-        topic = msg.topic
-        data = msg.payload
-        client_publisher.publish(topic, data, qos=1)
+        republish(msg.topic, msg.payload)
 
     def on_connect(client, userdata, flags, rc):
         if rc == mqtt.CONNACK_ACCEPTED:
@@ -45,7 +97,6 @@ def main(mqtt_from, to_mqtt, mqtt_topic, client_name=None):
             client_subscriber.message_callback_add(
                 mqtt_topic, on_message_wifi_packets_sub)
 
-    client_publisher.loop_start()
     client_subscriber.on_connect = on_connect
     client_subscriber.loop_start()
 
@@ -64,6 +115,23 @@ if __name__ == '__main__':
     @click.option('-to', '--to_mqtt', envvar='to_mqtt', help='A MQTT server url which destination server.')
     @click.option('-name', '--client_name', envvar='client_name', help='The MQTT client id.')
     @click.option('--mqtt_topic', default='artichoke/#', envvar='mqtt_topic', help='These MQTT topic(s) be listened to cloning data.')
+    @click.option('--queue_size', default=0, envvar='queue_size',
+                  help='Outbound queue of the publisher thread. 0 republishes from the subscriber callback.')
+    @click.option('--max_inflight', default=20, envvar='max_inflight', help='QoS1 messages waiting for PUBACK.')
+    @click.option('--coalesce', default=0, envvar='coalesce',
+                  help='Max payloads of one topic sent as one JSON array envelope. 0 disables it.')
+    @click.option('--coalesce_interval', default=200, envvar='coalesce_interval',
+                  help='Max milliseconds a payload waits for its envelope.')
+    @click.option('--report_interval', default=60, envvar='report_interval', help='Seconds between throughput logs.')
+    @click.option('--destinations', default=None, envvar='destinations',
+                  help='INI file of destination brokers with topic filters and sniffer allowlists. Replaces -to.')
+    @click.option('--store_dir', default=None, envvar='store_dir',
+                  help='Directory of the disk store-and-forward logs. Without it messages wait in memory.')
+    @click.option('--store_segment_mb', default=64, envvar='store_segment_mb', help='Size in MB of one store segment.')
+    @click.option('--drain_rate', default=0, envvar='drain_rate',
+                  help='Max payloads per second published to a destination. 0 is unlimited.')
+    @click.option('--compress', type=click.Choice(['zlib', 'zstd']), default=None, envvar='compress',
+                  help='Compress the published messages, best with --coalesce. zstd needs requirements.zstd.txt.')
     def run(*args, **kwargs):
         main(*args, **kwargs)
 
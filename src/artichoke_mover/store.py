@@ -0,0 +1,162 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import struct
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# topic length, payload length
+_HEADER = struct.Struct('>HI')
+
+
+class DiskQueue(object):
+    """
+    Segmented append-only log of (topic, payload) records with a checkpointed read offset.
+
+    The subscriber appends and the publisher thread reads, so a destination
+    outage grows files under `directory` instead of the process memory.
+    Segments are '{seq:010d}.seg' files of about `segment_bytes`; the
+    active one is fsynced every `fsync_interval` seconds. commit() stores
+    the position up to which every record was delivered in the
+    'checkpoint' file and deletes the segments before it. After a restart
+    reading resumes from the checkpoint, so undelivered records are sent
+    again (at least once).
+    """
+
+    SUFFIX = '.seg'
+    CHECKPOINT = 'checkpoint'
+
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024, fsync_interval=1.0):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        os.makedirs(directory, exist_ok=True)
+        self._cond = threading.Condition()
+
+        segments = self.segments()
+        self.checkpoint = self._load_checkpoint() or (segments[0] if segments else 0, 0)
+        self._write_seq = max(segments[-1] if segments else 0, self.checkpoint[0])
+        self._file = open(self._path(self._write_seq), 'ab', buffering=0)
+        self._write_size = os.path.getsize(self._path(self._write_seq))
+        self._last_fsync = time.time()
+        self._read_seq, self._read_offset = self.checkpoint
+        self._reader = None
+        if self.backlog_bytes():
+            logger.info(f'Store {directory}: {self.backlog_bytes()} bytes to forward since the last checkpoint.')
+
+    def segments(self):
+        return sorted(int(n[:-len(self.SUFFIX)]) for n in os.listdir(self.directory) if n.endswith(self.SUFFIX))
+
+    def backlog_bytes(self):
+        checkpoint = self.checkpoint
+        total = 0
+        for seq in self.segments():
+            if seq < checkpoint[0]:
+                continue
+            try:
+                total += os.path.getsize(self._path(seq))
+            except FileNotFoundError:
+                # delivered and removed by a concurrent commit()
+                continue
+        return max(total - checkpoint[1], 0)
+
+    def append(self, topic, payload):
+        topic = topic.encode('utf-8')
+        record = _HEADER.pack(len(topic), len(payload)) + topic + payload
+        with self._cond:
+            if self._write_size >= self.segment_bytes:
+                self._roll()
+            self._file.write(record)
+            self._write_size += len(record)
+            now = time.time()
+            if now - self._last_fsync >= self.fsync_interval:
+                os.fsync(self._file.fileno())
+                self._last_fsync = now
+            self._cond.notify()
+
+    def read(self, timeout):
+        """The next (topic, payload, position), or None when nothing arrives within `timeout`. """
+        waited = False
+        while True:
+            record = self._read_record()
+            if record is not None:
+                return record
+            with self._cond:
+                if self._read_seq < self._write_seq:
+                    # The segment is complete; read what was appended before the roll, then move on.
+                    record = self._read_record()
+                    if record is not None:
+                        return record
+                    self._next_segment()
+                    continue
+                if waited:
+                    return None
+                self._cond.wait(timeout)
+                waited = True
+
+    def commit(self, position):
+        """Record that everything before `position` was delivered. """
+        if position is None or position == self.checkpoint:
+            return
+        path = os.path.join(self.directory, self.CHECKPOINT)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(list(position), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        self.checkpoint = tuple(position)
+        for seq in self.segments():
+            if seq >= self.checkpoint[0]:
+                break
+            os.remove(self._path(seq))
+            logger.debug(f'Store {self.directory}: segment {seq} delivered.')
+
+    def close(self):
+        with self._cond:
+            os.fsync(self._file.fileno())
+            self._file.close()
+
+    def _path(self, seq):
+        return os.path.join(self.directory, f'{seq:010d}{self.SUFFIX}')
+
+    def _load_checkpoint(self):
+        try:
+            with open(os.path.join(self.directory, self.CHECKPOINT)) as f:
+                return tuple(json.load(f))
+        except FileNotFoundError:
+            return None
+
+    def _roll(self):
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._write_seq += 1
+        self._file = open(self._path(self._write_seq), 'ab', buffering=0)
+        self._write_size = 0
+
+    def _next_segment(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+        self._read_seq += 1
+        self._read_offset = 0
+
+    def _read_record(self):
+        if self._reader is None:
+            try:
+                self._reader = open(self._path(self._read_seq), 'rb')
+            except FileNotFoundError:
+                return None
+        self._reader.seek(self._read_offset)
+        header = self._reader.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            return None
+        topic_length, payload_length = _HEADER.unpack(header)
+        body = self._reader.read(topic_length + payload_length)
+        if len(body) < topic_length + payload_length:
+            return None
+        self._read_offset += _HEADER.size + len(body)
+        return body[:topic_length].decode('utf-8'), body[topic_length:], (self._read_seq, self._read_offset)
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python3
+"""
+asyncio ingest engine of mqtt_sub_postgres, selected with --engine async.
+
+gmqtt receives the messages and an asyncpg pool writes them. Rows are
+buffered per sniffer and every flush COPYs each sniffer's rows into its
+rawdata_{antenna_mac} table concurrently. asyncpg and gmqtt are optional
+dependencies (requirement_file/mqtt_sub_async.requirements.txt) and are
+only imported when the engine starts.
+"""
+
+import time
+import signal
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from collections import defaultdict
+
+from rawdata_writer import RAWDATA_COLUMNS
+from decoder import MessageDecoder
+from dedup import DuplicateFilter
+import metrics
+
+logger = logging.getLogger(__name__)
+
+INSERT_RAWDATA_ROW = """INSERT INTO
+    {}
+    ("rt", "sa", "da", "rssi", "seqno", "cname",
+        "pkt_type", "pkt_subtype", "ssid", "channel",
+        "upload_time", "delivery_time", "sniffer")
+    VALUES($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13)
+    """
+
+_TIMESTAMP_COLUMNS = ('rt', 'upload_time', 'delivery_time')
+
+
+_PG_EPOCH = datetime(2000, 1, 1, tzinfo=timezone.utc)
+_PG_EPOCH_SECONDS = 946684800
+
+
+def _timestamp(value):
+    # Rounded as PostgreSQL's to_timestamp() does, so both engines store the same microseconds.
+    if value is None:
+        return None
+    return _PG_EPOCH + timedelta(microseconds=round((value - _PG_EPOCH_SECONDS) * 1000000))
+
+
+def to_record(data):
+    """A decoded row as a rawdata record, with the epoch columns as timestamptz. """
+    return tuple(_timestamp(data.get(c)) if c in _TIMESTAMP_COLUMNS else data.get(c)
+                 for c in RAWDATA_COLUMNS)
+
+
+class AsyncBatchWriter(object):
+    """
+    Buffer decoded rows per sniffer and COPY them into rawdata_{antenna_mac}.
+
+    A flush starts when `batch_size` rows are buffered or the oldest row has
+    waited `batch_interval` seconds, and the sniffers of one flush are
+    written concurrently on connections of the pool. At most `max_flushes`
+    flushes run at once; add() waits beyond that, which holds back the
+    PUBACKs and so the broker. A rejected COPY is replayed row by row with
+    the 23505 / 23514 / 42P01 handling of RowWriter, and sniffers without a
+    table go to "imtest".rawdata for `missing_ttl` seconds.
+    """
+
+    def __init__(self, pool, batch_size=5000, batch_interval=0.5, max_flushes=4, missing_ttl=600):
+        import asyncpg
+
+        self._errors = asyncpg.exceptions
+        self.pool = pool
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.missing_ttl = missing_ttl
+        self._buffer = defaultdict(list)
+        self._pending = 0
+        self._oldest = 0.0
+        self._flushes = asyncio.Semaphore(max_flushes)
+        self._tasks = set()
+        self._missing = {}
+
+    async def add(self, antenna_mac, data):
+        if not self._pending:
+            self._oldest = time.time()
+        self._buffer[antenna_mac].append(to_record(data))
+        self._pending += 1
+        if self._pending >= self.batch_size:
+            await self._start_flush()
+
+    async def run_flusher(self):
+        while True:
+            await asyncio.sleep(min(self.batch_interval, 0.1))
+            if self._pending and time.time() - self._oldest >= self.batch_interval:
+                await self._start_flush()
+
+    async def close(self):
+        if self._pending:
+            await self._start_flush()
+        if self._tasks:
+            await asyncio.gather(*self._tasks)
+
+    async def _start_flush(self):
+        batch, self._buffer, self._pending = self._buffer, defaultdict(list), 0
+        await self._flushes.acquire()
+        task = asyncio.ensure_future(self._flush(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _flush(self, batch):
+        try:
+            start = time.time()
+            await asyncio.gather(*(self._write_table(mac, records) for mac, records in batch.items()))
+            elapsed = time.time() - start
+            size = sum(len(records) for records in batch.values())
+            metrics.BATCH_ROWS.observe(size)
+            metrics.FLUSH_LATENCY.observe(elapsed)
+            logger.debug('Flushed %d rows of %d sniffers in %.3f s.', size, len(batch), elapsed)
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            self._flushes.release()
+
+    def _is_missing(self, antenna_mac):
+        since = self._missing.get(antenna_mac)
+        if since is None:
+            return False
+        if time.time() - since > self.missing_ttl:
+            del self._missing[antenna_mac]
+            return False
+        return True
+
+    async def _write_table(self, antenna_mac, records):
+        errors = self._errors
+        while True:
+            try:
+                async with self.pool.acquire() as conn:
+                    if self._is_missing(antenna_mac):
+                        for record in records:
+                            await self._insert_imtest(conn, record)
+                        return
+                    start = time.time()
+                    try:
+                        await conn.copy_records_to_table('rawdata_{}'.format(antenna_mac), records=records,
+                                                         columns=RAWDATA_COLUMNS)
+                    except errors.PostgresConnectionError:
+                        raise
+                    except (errors.PostgresError, ValueError) as e:
+                        logger.debug('COPY of %d rows into rawdata_"%s" failed (%s), inserting row by row.',
+                                     len(records), antenna_mac, getattr(e, 'sqlstate', e))
+                        for record in records:
+                            await self._insert_row(conn, antenna_mac, record)
+                        return
+                    metrics.INSERT_LATENCY.observe(time.time() - start)
+                    metrics.ROWS_INSERTED.inc(len(records))
+                    return
+            except (OSError, errors.InterfaceError, errors.PostgresConnectionError) as e:
+                logger.exception(e)
+                metrics.DB_RETRIES.inc()
+                await asyncio.sleep(5)
+
+    async def _insert_row(self, conn, antenna_mac, record):
+        errors = self._errors
+        if self._is_missing(antenna_mac):
+            await self._insert_imtest(conn, record)
+            return
+        try:
+            await conn.execute(INSERT_RAWDATA_ROW.format('rawdata_{}'.format(antenna_mac)), *record)
+            metrics.ROWS_INSERTED.inc()
+        except errors.UniqueViolationError:
+            logger.debug('duplicate key value violates unique constraint', exc_info=True)
+            metrics.DUPLICATES.inc(label_value='database')
+        except errors.CheckViolationError:
+            logger.warning(
+                '''The rawdata_"%s" of partition key of the failing row contains. Inserting to "imtest".rawdata.''', antenna_mac)
+            await self._insert_imtest(conn, record)
+        except errors.UndefinedTableError:
+            logger.warning('The rawdata_"%s" is not found. Inserting to "imtest".rawdata.', antenna_mac)
+            self._missing[antenna_mac] = time.time()
+            await self._insert_imtest(conn, record)
+        except (errors.CharacterNotInRepertoireError, errors.UntranslatableCharacterError, ValueError):
+            logger.debug('A string literal cannot contain NUL.')
+        except errors.PostgresConnectionError:
+            raise
+        except errors.PostgresError as e:
+            logger.warning('SQL error: {}, {}'.format(e.sqlstate, e))
+            logger.exception(e)
+
+    async def _insert_imtest(self, conn, record):
+        errors = self._errors
+        try:
+            await conn.execute(INSERT_RAWDATA_ROW.format('"imtest".rawdata'), *record)
+            metrics.IMTEST_FALLBACK.inc()
+        except errors.UniqueViolationError:
+            logger.debug('duplicate key value violates unique constraint', exc_info=True)
+            metrics.DUPLICATES.inc(label_value='database')
+        except errors.PostgresConnectionError:
+            raise
+        except Exception as e:
+            logger.error(e, exc_info=True)
+
+
+def _asyncpg_dsn(db_url):
+    """asyncpg takes postgresql:// URLs without the SQLAlchemy driver name. """
+    scheme, sep, rest = db_url.partition('://')
+    return scheme.split('+')[0] + sep + rest
+
+
+async def _ingest(mqtt_server, mqtt_port, mqtt_topic, mqtt_client_id, mqtt_username, mqtt_password, db_url,
+                  batch_size, batch_interval, dedup_window, pool_size, accept, stop):
+    import asyncpg
+    from gmqtt import Client
+    from gmqtt.mqtt.constants import MQTTv311
+
+    pool = await asyncpg.create_pool(_asyncpg_dsn(db_url), min_size=1, max_size=pool_size)
+    writer = AsyncBatchWriter(pool, batch_size, batch_interval)
+    flusher = asyncio.ensure_future(writer.run_flusher())
+    logger.info('Async ingest engine: %d rows or %.1f s per flush, pool of %d connections.',
+                batch_size, batch_interval, pool_size)
+
+    decoder = MessageDecoder()
+    duplicates = None
+    if dedup_window > 0:
+        logger.info('Drop duplicate rows received within %d minutes.', dedup_window)
+        duplicates = DuplicateFilter(dedup_window)
+
+    def on_connect(client, flags, rc, properties):
+        client.subscribe(mqtt_topic, qos=1)
+
+    async def on_message(client, topic, payload, qos, properties):
+        antenna_mac = topic.split('/')[-1]
+        if not accept(antenna_mac):
+            return 0
+        metrics.MESSAGES_RECEIVED.inc(label_value=antenna_mac)
+        for data in decoder.decode_all(antenna_mac, payload):
+            rt = data.get('rt')
+            if rt is not None:
+                metrics.LAG.observe(data['delivery_time'] - rt)
+            if duplicates and duplicates.seen(antenna_mac, data):
+                metrics.DUPLICATES.inc(label_value='filter')
+                continue
+            await writer.add(antenna_mac, data)
+        return 0
+
+    # The PUBACK is sent once on_message returns, so a blocked writer holds back the broker.
+    client = Client(mqtt_client_id or '', clean_session=not mqtt_client_id, optimistic_acknowledgement=False)
+    if mqtt_username and mqtt_password:
+        client.set_auth_credentials(mqtt_username, mqtt_password)
+    client.on_connect = on_connect
+    client.on_message = on_message
+    await client.connect(mqtt_server, mqtt_port, version=MQTTv311)
+    try:
+        await stop.wait()
+    finally:
+        await client.disconnect()
+        flusher.cancel()
+        await writer.close()
+        await pool.close()
+
+
+def run(mqtt_server, mqtt_port, mqtt_topic, mqtt_client_id, mqtt_username, mqtt_password, db_url,
+        batch_size=5000, batch_interval=0.5, dedup_window=0, pool_size=10, accept=None):
+    """Run the async engine until SIGINT or SIGTERM. """
+    loop = asyncio.get_event_loop()
+    stop = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    loop.run_until_complete(_ingest(
+        mqtt_server, mqtt_port, mqtt_topic, mqtt_client_id, mqtt_username, mqtt_password, db_url,
+        batch_size, batch_interval, dedup_window, pool_size, accept or (lambda antenna_mac: True), stop))
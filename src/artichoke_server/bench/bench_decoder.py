@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python3
+"""
+Micro-benchmark of the on_message decoding step.
+
+Compares the decoding that on_message used to do inline with
+decoder.MessageDecoder on the same corpus:
+    python bench/bench_decoder.py --corpus corpus.jsonl
+    python bench/bench_decoder.py --count 200000
+"""
+
+import os
+import sys
+import json
+import time
+from datetime import datetime
+
+import click
+import pytz
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from decoder import MessageDecoder  # noqa: E402
+from payloads import synthesize, load_corpus  # noqa: E402
+
+tw = pytz.timezone('Asia/Taipei')
+
+
+def legacy_decode(topic, payload):
+    """The decoding on_message did before decoder.MessageDecoder. """
+    mqtt_msg = json.loads(payload)
+
+    antenna_mac = topic.split('/')[-1]
+    data = dict()
+    data.setdefault('ssid', '')
+    data.setdefault('cname', '')
+    data.setdefault('upload_time', None)
+    data.setdefault('delivery_time', datetime.utcnow())
+    data.setdefault('sniffer', antenna_mac)
+    data.setdefault('pkt_subtype', -1)
+
+    transfer_key = {
+        'rt': 'rt',
+        'type': 'pkt_type',
+        'subtype': 'pkt_subtype',
+        'Channel': 'channel',
+        'rssi': 'rssi',
+        'ssid': 'ssid',
+        'sa': 'sa',
+        'da': 'da',
+        'sn': 'seqno',
+        'cname': 'cname',
+        'upload_time': 'upload_time',
+    }
+    for old_k, new_k in transfer_key.items():
+        if old_k in mqtt_msg:
+            if old_k in ['sa', 'da']:
+                data[new_k] = mqtt_msg[old_k].replace(':', '').lower()
+            elif old_k in ['rt', 'upload_time']:
+                data[new_k] = str(datetime.fromtimestamp(
+                    mqtt_msg[old_k]).astimezone(tw))
+            else:
+                data[new_k] = mqtt_msg[old_k]
+    return antenna_mac, data
+
+
+def measure(name, func, corpus, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for topic, payload in corpus:
+            func(topic, payload)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    rate = len(corpus) / best
+    print('{:<28} {:>12,.0f} msg/s  ({:.2f} us/msg)'.format(name, rate, best / len(corpus) * 1e6))
+    return rate
+
+
+@click.command()
+@click.option('--corpus', default=None, help='JSON-lines corpus recorded by bench/payloads.py.')
+@click.option('--count', default=100000, help='Synthesized messages when no corpus is given.')
+@click.option('--repeat', default=3, help='Runs per decoder, the best one is reported.')
+def run(corpus, count, repeat):
+    messages = load_corpus(corpus) if corpus else synthesize(count)
+    print('{} messages from {}'.format(len(messages), corpus or 'synthesized payloads'))
+
+    decoder = MessageDecoder()
+    stdlib_decoder = MessageDecoder(loads=json.loads)
+
+    def fast(topic, payload):
+        return decoder.decode(topic.rpartition('/')[2], payload)
+
+    def fast_stdlib_json(topic, payload):
+        return stdlib_decoder.decode(topic.rpartition('/')[2], payload)
+
+    before = measure('legacy on_message decode', legacy_decode, messages, repeat)
+    measure('MessageDecoder (json)', fast_stdlib_json, messages, repeat)
+    after = measure('MessageDecoder', fast, messages, repeat)
+    print('speed-up: {:.1f}x'.format(after / before))
+
+
+if __name__ == '__main__':
+    run()
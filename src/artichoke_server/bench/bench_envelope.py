@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python3
+"""
+Bytes on the wire of artichoke_mover's envelopes.
+
+Groups the corpus per sniffer topic into batches as the mover's --coalesce
+does, packs them plain or compressed, and reports the MQTT bytes per
+payload and the mover / subscriber CPU cost:
+    python bench/bench_envelope.py --corpus corpus.jsonl --coalesce 1,10,50,200
+"""
+
+import os
+import sys
+import time
+from collections import defaultdict
+
+import click
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(_HERE))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(_HERE)), 'artichoke_mover'))
+
+from decoder import MessageDecoder  # noqa: E402
+from forwarder import envelope, compressor  # noqa: E402
+from payloads import synthesize, load_corpus  # noqa: E402
+
+
+def publish_bytes(topic, payload):
+    """A QoS1 PUBLISH and its PUBACK on the wire. """
+    remaining = 2 + len(topic.encode('utf-8')) + 2 + len(payload)
+    length_bytes = 1 if remaining < 128 else 2 if remaining < 16384 else 3 if remaining < 2097152 else 4
+    return 1 + length_bytes + remaining + 4
+
+
+def batches(corpus, coalesce):
+    per_topic = defaultdict(list)
+    for topic, payload in corpus:
+        per_topic[topic].append(payload)
+    for topic, payloads in per_topic.items():
+        for i in range(0, len(payloads), coalesce):
+            yield topic, payloads[i:i + coalesce]
+
+
+def measure(corpus, coalesce, codec, decoder):
+    pack = compressor(codec) if codec else (lambda data: data)
+    messages = []
+    start = time.process_time()
+    for topic, payloads in batches(corpus, coalesce):
+        data = envelope(payloads) if coalesce > 1 else payloads[0]
+        messages.append((topic, pack(data)))
+    pack_seconds = time.process_time() - start
+
+    start = time.process_time()
+    for topic, payload in messages:
+        decoder.decode_all(topic.rpartition('/')[2], payload)
+    decode_seconds = time.process_time() - start
+
+    wire = sum(publish_bytes(topic, payload) for topic, payload in messages)
+    return wire, len(messages), pack_seconds, decode_seconds
+
+
+@click.command()
+@click.option('--corpus', default=None, help='JSON-lines corpus recorded by bench/payloads.py.')
+@click.option('--count', default=100000, help='Synthesized messages when no corpus is given.')
+@click.option('--sniffers', default=10, help='Sniffers of the synthesized messages.')
+@click.option('--coalesce', default='1,10,50,200', help='Comma separated envelope sizes.')
+def run(corpus, count, sniffers, coalesce):
+    messages = load_corpus(corpus) if corpus else synthesize(count, sniffers)
+    print('{} messages from {}'.format(len(messages), corpus or 'synthesized payloads'))
+
+    codecs = [None, 'zlib']
+    try:
+        import zstandard  # noqa: F401
+        codecs.append('zstd')
+    except ImportError:
+        print('zstandard is not installed, skipping zstd.')
+
+    decoder = MessageDecoder()
+    baseline = None
+    print('{:>8} {:>6} {:>12} {:>10} {:>9} {:>14} {:>14}'.format(
+        'coalesce', 'codec', 'bytes', 'B/payload', 'vs raw', 'pack us/pl', 'decode us/pl'))
+    for size in (int(s) for s in coalesce.split(',')):
+        for codec in codecs:
+            wire, _, pack_seconds, decode_seconds = measure(messages, size, codec, decoder)
+            if baseline is None:
+                baseline = wire
+            print('{:>8} {:>6} {:>12,} {:>10.1f} {:>8.1%} {:>14.2f} {:>14.2f}'.format(
+                size, codec or 'none', wire, wire / len(messages), wire / baseline,
+                pack_seconds / len(messages) * 1e6, decode_seconds / len(messages) * 1e6))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python3
+"""
+Load generator and benchmark of the MQTT to PostgreSQL ingest.
+
+N simulated sniffers send artichoke probe payloads at a fixed rate, either
+straight into the ingest handler of mqtt_sub_postgres (in-process) or
+through a broker to a running subscriber. The report is read from the
+metrics of metrics.py, so both modes measure the same counters:
+    python bench/loadgen.py --db_url postgresql+psycopg2://postgres@localhost/postgres \\
+        --sniffers 50 --rate 20 --duration 60 --batch_size 1000 --create_tables
+    python bench/loadgen.py --mode broker --mqtt_server localhost \\
+        --metrics_url http://localhost:9100/metrics --sniffers 50 --rate 20
+
+In broker mode the subscriber has to run with --metrics_port.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import logging
+import urllib.request
+
+import click
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from payloads import sniffer_macs, synthesize_payload  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+CREATE_SNIFFER_TABLE = """CREATE TABLE IF NOT EXISTS rawdata_{mac} PARTITION OF rawdata
+    (PRIMARY KEY (rt, sa)) FOR VALUES IN ('{mac}')"""
+
+
+def generate(sniffers, count, seed=0, topic_prefix='artichoke'):
+    """
+    `count` (topic, payload prefix) pairs, round-robin over the sniffers.
+
+    The payloads lack rt and upload_time: stamp() appends them when the
+    message is sent, so the lag metrics see the real send time.
+    """
+    rng = random.Random(seed)
+    topics = ['{}/{}'.format(topic_prefix, mac) for mac in sniffer_macs(sniffers)]
+    messages = []
+    for i in range(count):
+        payload = synthesize_payload(rng, 0, i)
+        del payload['rt'], payload['upload_time']
+        messages.append((topics[i % sniffers], json.dumps(payload).encode('utf-8')[:-1]))
+    return messages
+
+
+def stamp(prefix, now):
+    rt = '{:.6f}'.format(now).encode('ascii')
+    return prefix + b', "rt": ' + rt + b', "upload_time": ' + rt + b'}'
+
+
+def parse_metrics(text):
+    """{metric name with labels: value} of a Prometheus text exposition. """
+    samples = {}
+    for line in text.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        name, _, value = line.rpartition(' ')
+        samples[name] = float(value)
+    return samples
+
+
+def metric_sum(samples, name):
+    return sum(v for k, v in samples.items() if k == name or k.startswith(name + '{'))
+
+
+def histogram_quantile(q, before, after, name):
+    """Quantile of the observations between two snapshots, interpolated inside the bucket. """
+    buckets = []
+    prefix = name + '_bucket{le="'
+    for key, value in after.items():
+        if key.startswith(prefix):
+            le = key[len(prefix):-2]
+            bound = float('inf') if le == '+Inf' else float(le)
+            buckets.append((bound, value - before.get(key, 0)))
+    buckets.sort()
+    if not buckets or buckets[-1][1] == 0:
+        return None
+    rank = q * buckets[-1][1]
+    lower, lower_count = 0.0, 0
+    for bound, count in buckets:
+        if count >= rank:
+            if bound == float('inf'):
+                return lower
+            if count == lower_count:
+                return bound
+            return lower + (bound - lower) * (rank - lower_count) / (count - lower_count)
+        lower, lower_count = bound, count
+    return lower
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def drive(messages, send, total_rate):
+    """Send the messages paced at `total_rate` msg/s (0 is unpaced). Returns the send latencies. """
+    latencies = []
+    start = time.time()
+    for i, (topic, prefix) in enumerate(messages):
+        if total_rate:
+            ahead = start + i / total_rate - time.time()
+            if ahead > 0.001:
+                time.sleep(ahead)
+        now = time.time()
+        send(topic, stamp(prefix, now))
+        latencies.append(time.time() - now)
+    return latencies, time.time() - start
+
+
+def report(sent, send_seconds, total_seconds, before, after, latencies=None):
+    def delta(name):
+        return metric_sum(after, name) - metric_sum(before, name)
+
+    def ms(value):
+        return 'n/a' if value is None else '{:.2f} ms'.format(value * 1000)
+
+    rows = delta('artichoke_rows_inserted_total')
+    imtest = delta('artichoke_imtest_fallback_total')
+    duplicates = delta('artichoke_duplicates_total')
+    cpu = delta('process_cpu_seconds_total')
+    print('sent {:,} messages in {:.1f} s ({:,.0f} msg/s)'.format(sent, send_seconds, sent / send_seconds))
+    print('received {:,.0f}, inserted {:,.0f} rows, imtest fallbacks {:,.0f}, duplicates {:,.0f}'.format(
+        delta('artichoke_messages_received_total'), rows, imtest, duplicates))
+    print('sustained {:,.0f} rows/s over {:.1f} s'.format(rows / total_seconds, total_seconds))
+    print('insert latency p50 {}, p99 {}'.format(
+        ms(histogram_quantile(0.5, before, after, 'artichoke_insert_seconds')),
+        ms(histogram_quantile(0.99, before, after, 'artichoke_insert_seconds'))))
+    print('ingest lag p50 {}, p99 {}'.format(
+        ms(histogram_quantile(0.5, before, after, 'artichoke_ingest_lag_seconds')),
+        ms(histogram_quantile(0.99, before, after, 'artichoke_ingest_lag_seconds'))))
+    if latencies:
+        print('handler latency p50 {}, p99 {}'.format(ms(percentile(latencies, 0.5)),
+                                                      ms(percentile(latencies, 0.99))))
+    print('CPU {:.3f} s per 1k messages'.format(cpu / sent * 1000 if sent else 0))
+
+
+def run_inprocess(messages, total_rate, db_url, create_tables, sniffers, **ingest_options):
+    from sqlalchemy import create_engine
+    import metrics
+    from mqtt_sub_postgres import build_ingest
+
+    writers = ingest_options.get('writers', 0)
+    engine = create_engine(db_url, pool_size=max(5, writers * 2))
+    if create_tables:
+        for mac in sniffer_macs(sniffers):
+            engine.execute(CREATE_SNIFFER_TABLE.format(mac=mac))
+
+    ingest, stop = build_ingest(engine, **ingest_options)
+
+    def send(topic, payload):
+        ingest(topic.rpartition('/')[2], payload)
+
+    before = parse_metrics(metrics.render())
+    start = time.time()
+    latencies, send_seconds = drive(messages, send, total_rate)
+    stop()
+    total_seconds = time.time() - start
+    report(len(messages), send_seconds, total_seconds, before, parse_metrics(metrics.render()), latencies)
+
+
+def run_broker(messages, total_rate, mqtt_server, mqtt_port, qos, metrics_url, drain_timeout):
+    import paho.mqtt.client as mqtt
+
+    def scrape():
+        with urllib.request.urlopen(metrics_url, timeout=10) as response:
+            return parse_metrics(response.read().decode('utf-8'))
+
+    def settled(samples):
+        return sum(metric_sum(samples, name) for name in (
+            'artichoke_rows_inserted_total', 'artichoke_imtest_fallback_total', 'artichoke_duplicates_total'))
+
+    client = mqtt.Client()
+    client.max_inflight_messages_set(1000)
+    client.connect(mqtt_server, mqtt_port)
+    client.loop_start()
+
+    def send(topic, payload):
+        client.publish(topic, payload, qos=qos)
+
+    before = scrape()
+    start = time.time()
+    _, send_seconds = drive(messages, send, total_rate)
+
+    # Wait until the subscriber has written everything or stops making progress.
+    target = settled(before) + len(messages)
+    after, last, idle_since = scrape(), None, time.time()
+    while settled(after) < target and time.time() - idle_since < drain_timeout:
+        time.sleep(0.5)
+        after = scrape()
+        if settled(after) != last:
+            last, idle_since = settled(after), time.time()
+    total_seconds = time.time() - start
+    client.loop_stop()
+    client.disconnect()
+    report(len(messages), send_seconds, total_seconds, before, after)
+
+
+@click.command()
+@click.option('--mode', type=click.Choice(['inprocess', 'broker']), default='inprocess',
+              help='Call the ingest handler directly or publish to a broker.')
+@click.option('--sniffers', default=10, help='Simulated sniffers.')
+@click.option('--rate', default=10.0, help='Messages per second of one sniffer. 0 sends as fast as possible.')
+@click.option('--duration', default=30, help='Seconds of load when paced.')
+@click.option('--count', default=100000, help='Messages to send when --rate is 0.')
+@click.option('--seed', default=0, help='Random seed of the payloads.')
+@click.option('--db_url', envvar='db_url', help='PostgreSQL URL of the in-process mode.')
+@click.option('--create_tables', is_flag=True, help='Create the rawdata_<sniffer> partitions of the simulated sniffers.')
+@click.option('--batch_size', default=0, help='As in mqtt_sub_postgres.')
+@click.option('--batch_interval', default=500, help='As in mqtt_sub_postgres.')
+@click.option('--writers', default=0, help='As in mqtt_sub_postgres.')
+@click.option('--queue_size', default=10000, help='As in mqtt_sub_postgres.')
+@click.option('--dedup_window', default=0, help='As in mqtt_sub_postgres.')
+@click.option('--mqtt_server', default='localhost', help='Broker of the broker mode.')
+@click.option('--mqtt_port', default=1883, help='Broker port of the broker mode.')
+@click.option('--qos', default=1, help='QoS of the published messages.')
+@click.option('--metrics_url', default='http://localhost:9100/metrics', help='Metrics endpoint of the subscriber.')
+@click.option('--drain_timeout', default=30, help='Seconds without progress before the broker mode stops waiting.')
+def run(mode, sniffers, rate, duration, count, seed, db_url, create_tables, batch_size, batch_interval, writers,
+        queue_size, dedup_window, mqtt_server, mqtt_port, qos, metrics_url, drain_timeout):
+    total_rate = sniffers * rate
+    if total_rate:
+        count = int(total_rate * duration)
+    messages = generate(sniffers, count, seed)
+    print('{} mode, {} sniffers, {:,} messages at {}'.format(
+        mode, sniffers, len(messages), '{:,.0f} msg/s'.format(total_rate) if total_rate else 'full speed'))
+
+    if mode == 'inprocess':
+        if not db_url:
+            raise click.UsageError('--db_url is required in the inprocess mode.')
+        run_inprocess(messages, total_rate, db_url, create_tables, sniffers, batch_size=batch_size,
+                      batch_interval=batch_interval, writers=writers, queue_size=queue_size,
+                      dedup_window=dedup_window)
+    else:
+        run_broker(messages, total_rate, mqtt_server, mqtt_port, qos, metrics_url, drain_timeout)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    run()
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python3
+"""
+Artichoke probe payloads for the ingest benchmarks.
+
+A corpus is a JSON-lines file of {"topic": ..., "payload": ...} records.
+Record one from a live broker with:
+    python bench/payloads.py --mqtt_server 10.101.26.187 --count 100000 corpus.jsonl
+"""
+
+import json
+import time
+import random
+import logging
+
+import click
+
+logger = logging.getLogger(__name__)
+
+CNAMES = ['SamsungE', 'Apple', 'Google_Random', None, 'HuaweiTe', 'XiaomiCo', 'AsustekC', 'vivoMobi', 'Oppo']
+
+
+def sniffer_macs(sniffers):
+    return ['aabbcc{:06x}'.format(i) for i in range(sniffers)]
+
+
+def _colon_mac(value):
+    return ':'.join('{:02x}'.format(b) for b in value.to_bytes(6, 'big'))
+
+
+def synthesize_payload(rng, rt, sn, devices=5000):
+    """One probe frame in the schema the sniffers publish. """
+    payload = {
+        'rt': round(rt, 6),
+        'sa': _colon_mac(0xf0d7aa000000 + rng.randrange(devices)),
+        'da': 'ff:ff:ff:ff:ff:ff',
+        'rssi': rng.randint(-95, -30),
+        'sn': sn % 4096,
+        'type': 0,
+        'subtype': 4,
+        'Channel': rng.choice((1, 6, 11)),
+        'upload_time': round(rt + rng.random(), 6),
+    }
+    cname = rng.choice(CNAMES)
+    if cname is not None:
+        payload['cname'] = cname
+    return payload
+
+
+def synthesize(count, sniffers=10, seed=0, topic_prefix='artichoke'):
+    """`count` (topic, payload bytes) pairs spread round-robin over the sniffers. """
+    rng = random.Random(seed)
+    macs = sniffer_macs(sniffers)
+    now = time.time()
+    corpus = []
+    for i in range(count):
+        mac = macs[i % sniffers]
+        payload = synthesize_payload(rng, now + i * 0.001, i)
+        corpus.append(('{}/{}'.format(topic_prefix, mac), json.dumps(payload).encode('utf-8')))
+    return corpus
+
+
+def load_corpus(path):
+    corpus = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                corpus.append((record['topic'], record['payload'].encode('utf-8')))
+    return corpus
+
+
+def record_corpus(path, mqtt_server, mqtt_port, mqtt_topic, count, username=None, password=None):
+    import paho.mqtt.client as mqtt
+
+    recorded = []
+    client = mqtt.Client()
+    if username and password:
+        client.username_pw_set(username, password)
+
+    def on_connect(client, userdata, flags, rc):
+        client.subscribe(mqtt_topic, qos=0)
+
+    def on_message(client, userdata, msg):
+        recorded.append({'topic': msg.topic, 'payload': msg.payload.decode('utf-8', 'replace')})
+        if len(recorded) >= count:
+            client.disconnect()
+
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.connect(mqtt_server, mqtt_port)
+    client.loop_forever()
+
+    with open(path, 'w', encoding='utf-8') as f:
+        for record in recorded:
+            f.write(json.dumps(record) + '\n')
+    logger.info('Recorded %d messages to %s.', len(recorded), path)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    @click.command()
+    @click.option('--mqtt_server', default='10.101.26.187', envvar='mqtt_server', help='The MQTT Server.')
+    @click.option('--mqtt_port', default=1883, envvar='mqtt_port', help='The MQTT port.')
+    @click.option('--mqtt_topic', default='artichoke/#', envvar='mqtt_topic', help='The MQTT topic.')
+    @click.option('--mqtt_username', default=None, envvar='mqtt_username', help='The MQTT username.')
+    @click.option('--mqtt_password', default=None, envvar='mqtt_password', help='The MQTT password.')
+    @click.option('--count', default=100000, help='Number of messages to record.')
+    @click.argument('path')
+    def run(path, mqtt_server, mqtt_port, mqtt_topic, mqtt_username, mqtt_password, count):
+        record_corpus(path, mqtt_server, mqtt_port, mqtt_topic, count, mqtt_username, mqtt_password)
+
+    run()
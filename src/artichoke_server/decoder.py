@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python3
+
+import json
+import time
+import zlib
+
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+# Compressed envelopes of artichoke_mover: magic, codec byte, compressed JSON.
+ENVELOPE_MAGIC = b'\x00ART'
+
+_zstd = None
+
+
+def _zstd_decompress(data):
+    global _zstd
+    if _zstd is None:
+        import zstandard
+        _zstd = zstandard.ZstdDecompressor()
+    return _zstd.decompress(data)
+
+
+def unpack(payload):
+    """The JSON of a payload, decompressed when it is a compressed envelope. """
+    if payload[:4] != ENVELOPE_MAGIC:
+        return payload
+    codec = payload[4:5]
+    if codec == b'z':
+        return zlib.decompress(payload[5:])
+    if codec == b's':
+        return _zstd_decompress(payload[5:])
+    raise ValueError('Unknown envelope codec {!r}.'.format(codec))
+
+
+def _mac(value):
+    # remove colon sign
+    return value.replace(':', '').lower()
+
+
+class MessageDecoder(object):
+    """
+    Decode an artichoke probe payload into a rawdata row.
+
+    The key table is built once. rt, upload_time and delivery_time stay as
+    epoch seconds and the INSERT statements wrap them with to_timestamp(),
+    so PostgreSQL does the timestamptz conversion instead of Python.
+    """
+
+    # payload key: (rawdata column, converter)
+    FIELDS = {
+        'rt': ('rt', None),
+        'type': ('pkt_type', None),
+        'subtype': ('pkt_subtype', None),
+        'Channel': ('channel', None),
+        'rssi': ('rssi', None),
+        'ssid': ('ssid', None),
+        'sa': ('sa', _mac),
+        'da': ('da', _mac),
+        'sn': ('seqno', None),
+        'cname': ('cname', None),
+        'upload_time': ('upload_time', None),
+    }
+
+    def __init__(self, loads=loads):
+        self._loads = loads
+
+    def decode(self, antenna_mac, payload):
+        return self._row(antenna_mac, self._loads(payload), time.time())
+
+    def decode_all(self, antenna_mac, payload):
+        """
+        The rows of a payload: one frame, or a JSON array envelope of frames
+        from artichoke_mover, optionally compressed.
+        """
+        message = self._loads(unpack(payload))
+        delivery_time = time.time()
+        if isinstance(message, list):
+            return [self._row(antenna_mac, m, delivery_time) for m in message]
+        return [self._row(antenna_mac, message, delivery_time)]
+
+    def _row(self, antenna_mac, message, delivery_time):
+        fields = self.FIELDS
+        data = {
+            'ssid': '',
+            'cname': '',
+            'upload_time': None,
+            'delivery_time': delivery_time,
+            'sniffer': antenna_mac,
+            # set default as -1, 修正 raw data 沒有 subtype 時 insert 到 raw data table 發生 error 無法寫入, 先 workaround 讓資料寫入
+            'pkt_subtype': -1,
+        }
+        for key, value in message.items():
+            field = fields.get(key)
+            if field is None:
+                continue
+            column, convert = field
+            data[column] = convert(value) if convert else value
+        return data
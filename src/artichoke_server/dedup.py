@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python3
+
+import time
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class DuplicateFilter(object):
+    """
+    Drop rows that were already received within the last `window` minutes.
+
+    Keys are (sniffer, rt, sa), the primary key of the rawdata tables, so a
+    QoS1 redelivery or a client resend is dropped before it reaches
+    PostgreSQL as a 23505. Keys are kept in one set per arrival minute and
+    whole buckets expire once they are older than the window. A bucket
+    holds at most `max_bucket_keys` keys; past that, new keys pass through
+    unrecorded instead of growing the set.
+
+    It is meant for the MQTT receive thread only and is not thread-safe.
+    """
+
+    def __init__(self, window=2, max_bucket_keys=1000000):
+        self.window = window
+        self.max_bucket_keys = max_bucket_keys
+        self._buckets = OrderedDict()
+        self.suppressed = 0
+        self.passed = 0
+        self._suppressed_at_rotate = 0
+
+    def seen(self, antenna_mac, data):
+        key = (antenna_mac, data.get('rt'), data.get('sa'))
+        minute = int(time.time() // 60)
+        current = self._buckets.get(minute)
+        if current is None:
+            current = self._rotate(minute)
+
+        for bucket in self._buckets.values():
+            if key in bucket:
+                self.suppressed += 1
+                return True
+        if len(current) < self.max_bucket_keys:
+            current.add(key)
+        self.passed += 1
+        return False
+
+    def stats(self):
+        return {
+            'suppressed': self.suppressed,
+            'passed': self.passed,
+            'keys': sum(len(b) for b in self._buckets.values()),
+        }
+
+    def _rotate(self, minute):
+        while self._buckets and next(iter(self._buckets)) <= minute - self.window:
+            self._buckets.popitem(last=False)
+        suppressed = self.suppressed - self._suppressed_at_rotate
+        if suppressed:
+            logger.info('Suppressed %d duplicate rows in the last minute (%d in total).',
+                        suppressed, self.suppressed)
+        self._suppressed_at_rotate = self.suppressed
+        current = self._buckets[minute] = set()
+        return current
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python3
+"""
+Ingest metrics of mqtt_sub_postgres in the Prometheus text format.
+
+The metrics are module-level objects that the ingest modules update.
+start_http_server() serves them on /metrics when --metrics_port is set.
+"""
+
+import time
+import bisect
+import logging
+import threading
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+logger = logging.getLogger(__name__)
+
+_metrics = []
+
+
+def _label_str(label, value):
+    return '{{{}="{}"}}'.format(label, value) if label else ''
+
+
+class Counter(object):
+    def __init__(self, name, doc, label=None):
+        self.name, self.doc, self.label = name, doc, label
+        self._values = {}
+        self._function = None
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, amount=1, label_value=None):
+        with self._lock:
+            self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def set_function(self, function):
+        """Read the total from function() instead, for a total counted elsewhere. """
+        self._function = function
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.doc), '# TYPE {} counter'.format(self.name)]
+        if self._function is not None:
+            return lines + ['{} {}'.format(self.name, self._function())]
+        with self._lock:
+            values = sorted(self._values.items(), key=lambda kv: str(kv[0]))
+        for label_value, value in values:
+            lines.append('{}{} {}'.format(self.name, _label_str(self.label, label_value), value))
+        return lines
+
+
+class Gauge(object):
+    def __init__(self, name, doc):
+        self.name, self.doc = name, doc
+        self._function = None
+        _metrics.append(self)
+
+    def set_function(self, function):
+        self._function = function
+
+    def render(self):
+        if self._function is None:
+            return []
+        return ['# HELP {} {}'.format(self.name, self.doc), '# TYPE {} gauge'.format(self.name),
+                '{} {}'.format(self.name, self._function())]
+
+
+class Histogram(object):
+    def __init__(self, name, doc, buckets):
+        self.name, self.doc = name, doc
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.doc), '# TYPE {} histogram'.format(self.name)]
+        with self._lock:
+            counts, total = list(self._counts), self._sum
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            lines.append('{}_bucket{{le="{}"}} {}'.format(self.name, bound, cumulative))
+        cumulative += counts[-1]
+        lines.append('{}_bucket{{le="+Inf"}} {}'.format(self.name, cumulative))
+        lines.append('{}_sum {}'.format(self.name, total))
+        lines.append('{}_count {}'.format(self.name, cumulative))
+        return lines
+
+
+_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+MESSAGES_RECEIVED = Counter('artichoke_messages_received_total', 'MQTT messages received.', 'sniffer')
+ROWS_INSERTED = Counter('artichoke_rows_inserted_total', 'Rows written into rawdata tables.')
+IMTEST_FALLBACK = Counter('artichoke_imtest_fallback_total', 'Rows written into "imtest".rawdata instead.')
+DUPLICATES = Counter('artichoke_duplicates_total', 'Duplicate rows, dropped in memory or by the database.', 'stage')
+DB_RETRIES = Counter('artichoke_db_retries_total', 'Database writes retried or spooled after a lost connection.')
+INSERT_LATENCY = Histogram('artichoke_insert_seconds', 'Latency of one INSERT statement, single or multi-row.',
+                           _LATENCY_BUCKETS)
+BATCH_ROWS = Histogram('artichoke_batch_rows', 'Rows per batch flush.',
+                       (10, 50, 100, 500, 1000, 2500, 5000, 10000, 50000))
+FLUSH_LATENCY = Histogram('artichoke_flush_seconds', 'Latency of one batch flush over all sniffers.',
+                          _LATENCY_BUCKETS)
+LAG = Histogram('artichoke_ingest_lag_seconds', 'delivery_time - rt of the received rows.',
+                (0.005, 0.025, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, 300, 900, 3600, 86400))
+QUEUE_DEPTH = Gauge('artichoke_queue_depth', 'Rows waiting for the pipeline writers.')
+SPOOL_BYTES = Gauge('artichoke_spool_bytes', 'Bytes kept in the disk spool.')
+PROCESS_CPU = Counter('process_cpu_seconds_total', 'User and system CPU time of the process.')
+PROCESS_CPU.set_function(time.process_time)
+
+
+def render():
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_http_server(port, addr=''):
+    server = _ThreadingHTTPServer((addr, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='MetricsServer', daemon=True)
+    thread.start()
+    logger.info('Serving metrics on port %d.', port)
+    return server
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python3
+
+import time
+import queue
+import logging
+import threading
+
+from rawdata_writer import RowWriter, BatchWriter
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class IngestPipeline(object):
+    """
+    Decouple the MQTT receive thread from the database writes.
+
+    on_message only decodes and calls put(). Rows wait in a bounded queue
+    and N writer threads drain it, each holding its own database connection
+    (a BatchWriter when batching is on). When the queue reaches its
+    high-water mark, put() blocks the paho loop, so the broker stops
+    delivering instead of the process growing without limit.
+    """
+
+    def __init__(self, engine, writers=2, high_water_mark=10000, batch_size=0, batch_interval=0.5,
+                 spool=None, report_interval=60):
+        self.engine = engine
+        self.spool = spool
+        self.writers = writers
+        self.high_water_mark = high_water_mark
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.report_interval = report_interval
+        self.queue = queue.Queue(maxsize=high_water_mark)
+        self._threads = []
+        self._written = [0] * writers
+        self._stop = threading.Event()
+        self._full_count = 0
+
+    def put(self, antenna_mac, data):
+        try:
+            self.queue.put_nowait((antenna_mac, data))
+        except queue.Full:
+            self._full_count += 1
+            self.queue.put((antenna_mac, data))
+
+    def start(self):
+        for index in range(self.writers):
+            thread = threading.Thread(target=self._run_writer, args=(index,),
+                                      name='Writer-{}'.format(index), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        threading.Thread(target=self._run_reporter, name='PipelineReporter', daemon=True).start()
+        logger.info('Ingest pipeline started with %d writers, high-water mark %d.',
+                    self.writers, self.high_water_mark)
+
+    def stop(self):
+        """Drain the queue and stop the writers. """
+        for _ in self._threads:
+            self.queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        self._stop.set()
+
+    def _run_writer(self, index):
+        if self.batch_size > 0:
+            batch_writer = BatchWriter(self.engine, self.batch_size, self.batch_interval, self.spool)
+            row_writer = None
+        else:
+            batch_writer = None
+            row_writer = RowWriter(self.engine, self.spool)
+        poll = min(self.batch_interval, 0.1)
+
+        while True:
+            try:
+                item = self.queue.get(timeout=poll)
+            except queue.Empty:
+                item = None
+            if item is _STOP:
+                break
+            try:
+                if item is not None:
+                    antenna_mac, data = item
+                    if batch_writer:
+                        batch_writer.add(antenna_mac, data)
+                    else:
+                        row_writer.insert(antenna_mac, data)
+                    self._written[index] += 1
+                if batch_writer:
+                    batch_writer.flush_if_due()
+            except Exception as e:
+                logger.exception(e)
+
+        if batch_writer:
+            batch_writer.flush()
+
+    def _run_reporter(self):
+        last = list(self._written)
+        last_time = time.time()
+        while not self._stop.wait(self.report_interval):
+            now = time.time()
+            written = list(self._written)
+            elapsed = now - last_time
+            rates = ['{:.1f}'.format((w - l) / elapsed) for w, l in zip(written, last)]
+            logger.info('Ingest queue depth: %d/%d, reached high-water mark %d times, writer rows/s: [%s]',
+                        self.queue.qsize(), self.high_water_mark, self._full_count, ', '.join(rates))
+            last, last_time = written, now
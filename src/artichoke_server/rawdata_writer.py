@@ -0,0 +1,409 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python3
+
+import time
+import logging
+import threading
+from collections import defaultdict, OrderedDict
+
+import psycopg2
+from psycopg2.extras import execute_values
+from sqlalchemy.sql import text
+import sqlalchemy.exc
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+RAWDATA_COLUMNS = ("rt", "sa", "da", "rssi", "seqno", "cname",
+                   "pkt_type", "pkt_subtype", "ssid", "channel",
+                   "upload_time", "delivery_time", "sniffer")
+
+INSERT_RAWDATA_VALUES = """INSERT INTO
+    rawdata_{}
+    ("rt", "sa", "da", "rssi", "seqno", "cname",
+        "pkt_type", "pkt_subtype", "ssid", "channel",
+        "upload_time", "delivery_time", "sniffer")
+    VALUES %s
+    """
+
+PREPARE_RAWDATA = """PREPARE {name} AS INSERT INTO
+    rawdata_{antenna_mac}
+    ("rt", "sa", "da", "rssi", "seqno", "cname",
+        "pkt_type", "pkt_subtype", "ssid", "channel",
+        "upload_time", "delivery_time", "sniffer")
+    VALUES(
+    to_timestamp($1), $2, $3, $4, $5, $6, $7, $8, $9, $10,
+        to_timestamp($11), to_timestamp($12), $13)
+    """
+
+EXECUTE_RAWDATA = "EXECUTE {} (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"
+
+# rt, upload_time and delivery_time are epoch seconds, see decoder.MessageDecoder.
+INSERT_RAWDATA_TEMPLATE = """(to_timestamp(%s), %s, %s, %s, %s, %s, %s, %s, %s, %s,
+    to_timestamp(%s), to_timestamp(%s), %s)"""
+
+
+def insert2imtest(engine, **data):
+    try:
+        engine.execute(
+            text(
+                """INSERT INTO
+                "imtest".rawdata
+                ("rt", "sa", "da", "rssi", "seqno", "cname",
+                    "pkt_type", "pkt_subtype", "ssid", "channel",
+                    "upload_time", "delivery_time", "sniffer")
+                VALUES(
+                to_timestamp(:rt), :sa, :da, :rssi, :seqno, :cname, :pkt_type, :pkt_subtype, :ssid, :channel,
+                    to_timestamp(:upload_time), to_timestamp(:delivery_time), :sniffer)
+                """
+            ),
+            **data
+        )
+        metrics.IMTEST_FALLBACK.inc()
+
+    except sqlalchemy.exc.IntegrityError as e:
+        if hasattr(e.orig, 'pgcode'):
+            if e.orig.pgcode == '23505':
+                logger.debug('duplicate key value violates unique constraint', exc_info=True)
+                metrics.DUPLICATES.inc(label_value='database')
+                return
+        logger.error(e, exc_info=True)
+    except Exception as e:
+        logger.error(e, exc_info=True)
+
+
+class RowWriter(object):
+    """
+    Insert decoded rows one by one into rawdata_{antenna_mac}, falling back to "imtest".rawdata.
+
+    Every sniffer gets a server-side PREPAREd INSERT on this writer's own
+    connection. At most `cache_size` statements are kept, and the least
+    recently used one is DEALLOCATEd when a new sniffer needs a slot. The
+    statement of a sniffer silent for `idle_ttl` seconds is DEALLOCATEd on
+    the next insert of any sniffer.
+    Sniffers whose table is missing (42P01) are remembered for `missing_ttl`
+    seconds, and their rows go straight to "imtest".rawdata.
+
+    Without a spool, a lost database connection is retried every 5 seconds.
+    With a spool, the row is appended to it instead and the spool is marked
+    as in outage.
+    """
+
+    def __init__(self, engine, spool=None, cache_size=512, missing_ttl=600, idle_ttl=600):
+        self.engine = engine
+        self.spool = spool
+        self.cache_size = cache_size
+        self.missing_ttl = missing_ttl
+        self.idle_ttl = idle_ttl
+        self._conn = None
+        # antenna_mac: statement name, least recently used first.
+        self._prepared = OrderedDict()
+        self._last_used = {}
+        self._missing = {}
+
+    def is_missing(self, antenna_mac):
+        since = self._missing.get(antenna_mac)
+        if since is None:
+            return False
+        if time.time() - since > self.missing_ttl:
+            del self._missing[antenna_mac]
+            return False
+        return True
+
+    def insert(self, antenna_mac, data):
+        if self.spool is not None and self.spool.outage:
+            self.spool.append(antenna_mac, data)
+            return
+        if self.is_missing(antenna_mac):
+            insert2imtest(self.engine, sniffer_mac=antenna_mac, **data)
+            return
+
+        logger.debug(
+            "Insert data into database. the data rt is %s and sniffer is %s.", data.get('rt'), antenna_mac)
+        values = tuple(data.get(c) for c in RAWDATA_COLUMNS)
+        while True:
+            try:
+                conn = self._connection()
+                start = time.time()
+                with conn.cursor() as cursor:
+                    name = self._prepare(cursor, antenna_mac)
+                    cursor.execute(EXECUTE_RAWDATA.format(name), values)
+                metrics.INSERT_LATENCY.observe(time.time() - start)
+                metrics.ROWS_INSERTED.inc()
+                return
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                logger.exception(e)
+                metrics.DB_RETRIES.inc()
+                self._discard_connection()
+                if self.spool is not None:
+                    self.spool.mark_down()
+                    self.spool.append(antenna_mac, data)
+                    return
+                time.sleep(5)
+            except psycopg2.Error as e:
+                self._handle_error(antenna_mac, data, e)
+                return
+            except ValueError as e:
+                logger.debug('A string literal cannot contain NUL.')
+                return
+            except Exception as e:
+                logger.exception(e)
+                return
+
+    def _handle_error(self, antenna_mac, data, e):
+        if e.pgcode == '23505':
+            logger.debug(
+                'duplicate key value violates unique constraint', exc_info=True)
+            metrics.DUPLICATES.inc(label_value='database')
+            return
+        # The statement of a failed sniffer is prepared again on its next row.
+        self._deallocate(antenna_mac)
+        if e.pgcode == '23514':
+            logger.warning(
+                '''The rawdata_"%s" of partition key of the failing row contains. Inserting to "imtest".rawdata.''', antenna_mac)
+            insert2imtest(self.engine, sniffer_mac=antenna_mac, **data)
+        elif e.pgcode == '42P01':
+            logger.warning(
+                'The rawdata_"%s" is not found. Inserting to "imtest".rawdata.', antenna_mac)
+            self._missing[antenna_mac] = time.time()
+            insert2imtest(self.engine, sniffer_mac=antenna_mac, **data)
+        else:
+            logger.warning('SQL error: {}, {}'.format(e.pgcode, e.pgerror))
+            logger.exception(e)
+
+    def _prepare(self, cursor, antenna_mac):
+        now = time.time()
+        self._evict_idle(cursor, now)
+        self._last_used[antenna_mac] = now
+        name = self._prepared.get(antenna_mac)
+        if name is not None:
+            self._prepared.move_to_end(antenna_mac)
+            return name
+        if len(self._prepared) >= self.cache_size:
+            silent_mac, silent_name = self._prepared.popitem(last=False)
+            self._last_used.pop(silent_mac, None)
+            cursor.execute('DEALLOCATE {}'.format(silent_name))
+        name = 'insert_rawdata_{}'.format(antenna_mac)
+        cursor.execute(PREPARE_RAWDATA.format(name=name, antenna_mac=antenna_mac))
+        self._prepared[antenna_mac] = name
+        return name
+
+    def _evict_idle(self, cursor, now):
+        """DEALLOCATE the statements unused for idle_ttl seconds, the oldest first. """
+        while self._prepared:
+            silent_mac, silent_name = next(iter(self._prepared.items()))
+            if now - self._last_used.get(silent_mac, now) <= self.idle_ttl:
+                return
+            del self._prepared[silent_mac]
+            del self._last_used[silent_mac]
+            cursor.execute('DEALLOCATE {}'.format(silent_name))
+
+    def _deallocate(self, antenna_mac):
+        self._last_used.pop(antenna_mac, None)
+        name = self._prepared.pop(antenna_mac, None)
+        if name is None:
+            return
+        try:
+            with self._conn.cursor() as cursor:
+                cursor.execute('DEALLOCATE {}'.format(name))
+        except psycopg2.Error:
+            pass
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = self.engine.raw_connection()
+            self._conn.set_session(autocommit=True)
+        return self._conn
+
+    def _discard_connection(self):
+        self._prepared.clear()
+        self._last_used.clear()
+        if self._conn is None:
+            return
+        try:
+            self._conn.invalidate()
+        except Exception:
+            pass
+        self._conn = None
+
+
+class BatchWriter(object):
+    """
+    Buffer decoded rows and write them as one multi-row INSERT per rawdata table.
+
+    Rows are grouped by antenna_mac and flushed when `batch_size` rows are
+    buffered or the oldest buffered row has waited `batch_interval` seconds.
+    If a table's batch is rejected (duplicate key, partition miss, missing
+    table, NUL in a string), it is rolled back and replayed row by row
+    through a RowWriter, so every row keeps the 23505 / 23514 / 42P01
+    handling of the unbuffered mode. Sniffers that RowWriter knows to have
+    no table skip the batch attempt. With a spool, batches that cannot
+    reach the database are appended to the spool instead of being retried.
+    """
+
+    REPORT_INTERVAL = 60
+
+    def __init__(self, engine, batch_size=5000, batch_interval=0.5, spool=None):
+        self.engine = engine
+        self.spool = spool
+        self.batch_size = batch_size
+        self._rows = RowWriter(engine, spool)
+        self.batch_interval = batch_interval
+        self._conn = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._buffer = defaultdict(list)
+        self._pending = 0
+        self._oldest = 0.0
+        self._stop = threading.Event()
+        self._last_report = time.time()
+
+        # Counters
+        self.flush_count = 0
+        self.rows_flushed = 0
+        self.fallback_batches = 0
+        self.last_batch_size = 0
+        self.max_batch_size = 0
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+        self.flush_seconds_total = 0.0
+
+    def add(self, antenna_mac, data):
+        with self._lock:
+            if not self._pending:
+                self._oldest = time.time()
+            self._buffer[antenna_mac].append(data)
+            self._pending += 1
+            if self._pending < self.batch_size:
+                return
+            batch = self._swap()
+        self.write(batch)
+
+    def flush(self):
+        with self._lock:
+            batch = self._swap()
+        self.write(batch)
+
+    def flush_if_due(self):
+        with self._lock:
+            if not self._pending or time.time() - self._oldest < self.batch_interval:
+                return False
+            batch = self._swap()
+        self.write(batch)
+        return True
+
+    def start(self):
+        """Flush on the time threshold from a daemon thread. """
+        def run():
+            while not self._stop.wait(min(self.batch_interval, 0.1)):
+                try:
+                    self.flush_if_due()
+                except Exception as e:
+                    logger.exception(e)
+
+        thread = threading.Thread(target=run, name='BatchFlusher', daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self._stop.set()
+        self.flush()
+
+    def stats(self):
+        return {
+            'flush_count': self.flush_count,
+            'rows_flushed': self.rows_flushed,
+            'fallback_batches': self.fallback_batches,
+            'last_batch_size': self.last_batch_size,
+            'max_batch_size': self.max_batch_size,
+            'last_flush_seconds': self.last_flush_seconds,
+            'max_flush_seconds': self.max_flush_seconds,
+            'avg_flush_seconds': self.flush_seconds_total / self.flush_count if self.flush_count else 0.0,
+        }
+
+    def _swap(self):
+        batch, self._buffer, self._pending = self._buffer, defaultdict(list), 0
+        return batch
+
+    def write(self, batch):
+        if not batch:
+            return
+        with self._flush_lock:
+            start = time.time()
+            size = 0
+            for antenna_mac, rows in batch.items():
+                self._write_table(antenna_mac, rows)
+                size += len(rows)
+            elapsed = time.time() - start
+
+            self.flush_count += 1
+            self.rows_flushed += size
+            self.last_batch_size = size
+            self.max_batch_size = max(self.max_batch_size, size)
+            self.last_flush_seconds = elapsed
+            self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+            self.flush_seconds_total += elapsed
+            metrics.BATCH_ROWS.observe(size)
+            metrics.FLUSH_LATENCY.observe(elapsed)
+            logger.debug('Flushed %d rows of %d sniffers in %.3f s.', size, len(batch), elapsed)
+            if start - self._last_report >= self.REPORT_INTERVAL:
+                self._last_report = start
+                logger.info('Batch writer stats: %s', self.stats())
+
+    def _write_table(self, antenna_mac, rows):
+        if self._rows.is_missing(antenna_mac):
+            for row in rows:
+                self._rows.insert(antenna_mac, row)
+            return
+        values = [tuple(row.get(c) for c in RAWDATA_COLUMNS) for row in rows]
+        while True:
+            if self.spool is not None and self.spool.outage:
+                self.spool.extend(antenna_mac, rows)
+                return
+            try:
+                conn = self._connection()
+                start = time.time()
+                with conn.cursor() as cursor:
+                    execute_values(cursor, INSERT_RAWDATA_VALUES.format(antenna_mac), values,
+                                   template=INSERT_RAWDATA_TEMPLATE, page_size=len(values))
+                conn.commit()
+                metrics.INSERT_LATENCY.observe(time.time() - start)
+                metrics.ROWS_INSERTED.inc(len(values))
+                return
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                logger.exception(e)
+                metrics.DB_RETRIES.inc()
+                self._discard_connection()
+                if self.spool is not None:
+                    self.spool.mark_down()
+                    continue
+                time.sleep(5)
+            except (psycopg2.Error, ValueError) as e:
+                self._rollback()
+                logger.debug('Batch of %d rows into rawdata_"%s" failed (%s), inserting row by row.',
+                             len(rows), antenna_mac, getattr(e, 'pgcode', e))
+                self.fallback_batches += 1
+                for row in rows:
+                    self._rows.insert(antenna_mac, row)
+                return
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = self.engine.raw_connection()
+        return self._conn
+
+    def _rollback(self):
+        try:
+            self._conn.rollback()
+        except psycopg2.Error:
+            self._discard_connection()
+
+    def _discard_connection(self):
+        if self._conn is None:
+            return
+        try:
+            self._conn.invalidate()
+        except Exception:
+            pass
+        self._conn = None
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import struct
+import logging
+import threading
+from collections import defaultdict
+
+from sqlalchemy.sql import text
+import sqlalchemy.exc
+
+from rawdata_writer import BatchWriter
+
+logger = logging.getLogger(__name__)
+
+_LENGTH = struct.Struct('>I')
+
+
+class Spool(object):
+    """
+    Append-only disk spool for decoded rows while PostgreSQL is unreachable.
+
+    Records are length-prefixed JSON documents of [antenna_mac, data] in
+    segment files named by a growing sequence number. Only closed segments
+    are replayed. A segment is deleted once all of its rows are written
+    back to the database or re-spooled into the active segment.
+    """
+
+    SUFFIX = '.seg'
+
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.outage = False
+        self._lock = threading.Lock()
+        self._active = None
+        self._active_path = None
+        self.spooled_rows = 0
+        self.replayed_rows = 0
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        existing = self.segments()
+        self._seq = int(os.path.basename(existing[-1])[:-len(self.SUFFIX)]) if existing else 0
+        if existing:
+            logger.warning('Found %d spool segments (%d bytes) in %s to replay.',
+                           len(existing), self.size_bytes(), directory)
+
+    def mark_down(self):
+        if not self.outage:
+            logger.error('Database is unreachable, spooling rows to %s.', self.directory)
+        self.outage = True
+
+    def append(self, antenna_mac, data):
+        self.extend(antenna_mac, [data])
+
+    def extend(self, antenna_mac, rows):
+        buf = bytearray()
+        for data in rows:
+            record = json.dumps([antenna_mac, data], default=str).encode('utf-8')
+            buf += _LENGTH.pack(len(record))
+            buf += record
+        with self._lock:
+            if self._active is None:
+                self._open_segment()
+            self._active.write(buf)
+            self.spooled_rows += len(rows)
+            if self._active.tell() >= self.segment_bytes:
+                self._close_segment()
+
+    def roll(self):
+        """Close the active segment so that it can be replayed. """
+        with self._lock:
+            if self._active is not None:
+                self._close_segment()
+
+    def has_data(self):
+        return self._active is not None or bool(self.segments())
+
+    def segments(self):
+        """Closed segment paths, oldest first. """
+        active = self._active_path
+        names = sorted(n for n in os.listdir(self.directory) if n.endswith(self.SUFFIX))
+        return [os.path.join(self.directory, n) for n in names
+                if os.path.join(self.directory, n) != active]
+
+    def size_bytes(self):
+        return sum(os.path.getsize(os.path.join(self.directory, n))
+                   for n in os.listdir(self.directory) if n.endswith(self.SUFFIX))
+
+    @staticmethod
+    def read_segment(path):
+        with open(path, 'rb') as f:
+            while True:
+                header = f.read(_LENGTH.size)
+                if len(header) < _LENGTH.size:
+                    return
+                length, = _LENGTH.unpack(header)
+                record = f.read(length)
+                if len(record) < length:
+                    logger.warning('Truncated record at the end of %s is skipped.', path)
+                    return
+                yield json.loads(record.decode('utf-8'))
+
+    def _open_segment(self):
+        self._seq += 1
+        self._active_path = os.path.join(self.directory, '{:010d}{}'.format(self._seq, self.SUFFIX))
+        self._active = open(self._active_path, 'ab')
+
+    def _close_segment(self):
+        self._active.flush()
+        os.fsync(self._active.fileno())
+        self._active.close()
+        logger.info('Closed spool segment %s, spool now holds %d bytes (%d rows spooled since start).',
+                    self._active_path, self.size_bytes(), self.spooled_rows)
+        self._active, self._active_path = None, None
+
+
+class SpoolReplayer(object):
+    """
+    Probe the database during an outage and replay the spool after reconnect.
+
+    Replay goes through BatchWriter in chunks of `batch_size` rows per
+    sniffer table. If the database drops again, the writer re-spools the
+    remaining rows and the replayer waits for the next probe.
+    """
+
+    def __init__(self, engine, spool, batch_size=5000, retry_interval=5):
+        self.engine = engine
+        self.spool = spool
+        self.batch_size = batch_size
+        self.retry_interval = retry_interval
+        self._writer = BatchWriter(engine, batch_size, spool=spool)
+        self._stop = threading.Event()
+
+    def start(self):
+        thread = threading.Thread(target=self._run, name='SpoolReplayer', daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.retry_interval):
+            if not self.spool.outage and not self.spool.has_data():
+                continue
+            if not self._database_alive():
+                continue
+            if self.spool.outage:
+                logger.info('Database is reachable again, replaying the spool.')
+                self.spool.outage = False
+            try:
+                self.replay()
+            except Exception as e:
+                logger.exception(e)
+
+    def _database_alive(self):
+        try:
+            self.engine.execute(text('SELECT 1'))
+            return True
+        except sqlalchemy.exc.OperationalError:
+            return False
+
+    def replay(self):
+        self.spool.roll()
+        for path in self.spool.segments():
+            if self.spool.outage:
+                return
+            start, rows = time.time(), 0
+            batch, pending = defaultdict(list), 0
+            for antenna_mac, data in Spool.read_segment(path):
+                batch[antenna_mac].append(data)
+                pending += 1
+                if pending >= self.batch_size:
+                    self._writer.write(batch)
+                    rows += pending
+                    batch, pending = defaultdict(list), 0
+            self._writer.write(batch)
+            rows += pending
+            os.remove(path)
+            self.spool.replayed_rows += rows
+            elapsed = max(time.time() - start, 1e-6)
+            logger.info('Replayed %d rows from %s in %.1f s (%.0f rows/s), %d bytes left in the spool.',
+                        rows, os.path.basename(path), elapsed, rows / elapsed, self.spool.size_bytes())